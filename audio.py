@@ -0,0 +1,274 @@
+import logging, wave, os
+from time import monotonic, sleep
+from threading import Thread, Event, Lock
+
+# Capture format. This matches the arecord options that recordings have always been made with (S16_LE, 44.1 kHz, mono) so the capture PCM
+# can be opened once with fixed parameters.
+sample_rate   = 44100
+channels      = 1
+sample_width  = 2
+period_frames = 1024
+frame_bytes   = channels * sample_width
+
+capture_retry_s     = 1.0  # How long the capture pump waits before first trying to reopen a capture device that failed
+capture_retry_max_s = 30.0 # The longest it waits between later attempts
+capture_check_s     = 0.5  # How often capture() checks that the capture pump hasn't failed while it waits for the stop event
+
+# Raised by AudioEngine.play() when a file is in a format the backend can't play, e.g. an unsupported sample width. Callers are expected to
+# fall back to spawning aplay for that file.
+class AudioFormatError(Exception):
+    pass
+
+# Raised by AudioEngine.capture() when the capture device failed (e.g. the USB sound card was unplugged) before or during the capture, so
+# the frames that were meant to be recorded were lost. Callers are expected to fall back to spawning arecord or fail the recording.
+class AudioDeviceError(Exception):
+    pass
+
+# Backend that talks to an ALSA PCM through the pyalsaaudio module. The capture PCM and the playback PCM are opened once and held for the life
+# of the engine so that a call never has to wait for the device to be opened and configured. The playback PCM is only reopened if a file with
+# a different format to the previous one is played. The microphone can be on a different device to the speaker if capture_device is given.
+class AlsaBackend():
+    def __init__(self, device="plughw:1,0", capture_device=None):
+        import alsaaudio # Imported here so that the rest of the module (and the fake backend) works on machines without pyalsaaudio
+        self._alsaaudio = alsaaudio
+        self._device = device
+        self._capture_device = capture_device or device
+        self._formats = {1: alsaaudio.PCM_FORMAT_U8, 2: alsaaudio.PCM_FORMAT_S16_LE, 3: alsaaudio.PCM_FORMAT_S24_3LE, 4: alsaaudio.PCM_FORMAT_S32_LE}
+        self._playback = None
+        self._playback_params = None
+        self._capture = None
+
+    def __str__(self):
+        if self._capture_device == self._device: return "ALSA device %s" % self._device
+        return "ALSA devices %s (playback) and %s (capture)" % (self._device, self._capture_device)
+
+    def _open_pcm(self, pcm_type, params):
+        rate, nchannels, width = params
+        if width not in self._formats: raise AudioFormatError("%d byte samples are not supported" % width)
+        device = self._capture_device if pcm_type == self._alsaaudio.PCM_CAPTURE else self._device
+        return self._alsaaudio.PCM(type=pcm_type, mode=self._alsaaudio.PCM_NORMAL, device=device, rate=rate, channels=nchannels,
+                                   format=self._formats[width], periodsize=period_frames)
+
+    def open(self):
+        self._capture = self._open_pcm(self._alsaaudio.PCM_CAPTURE, (sample_rate, channels, sample_width))
+
+    def close(self):
+        for pcm in (self._playback, self._capture):
+            if pcm: pcm.close()
+        self._playback = self._capture = self._playback_params = None
+
+    # Close the capture PCM after a read failed and open it again, which raises if the device still isn't usable
+    def reopen_capture(self):
+        if self._capture:
+            try:
+                self._capture.close()
+            except self._alsaaudio.ALSAAudioError:
+                pass
+        self._capture = None
+        self.open()
+
+    # (Re)open the playback PCM for the given (rate, channels, sample width) if it isn't already configured that way
+    def set_playback_format(self, params):
+        if params == self._playback_params: return
+        if self._playback: self._playback.close()
+        self._playback, self._playback_params = None, None
+        self._playback = self._open_pcm(self._alsaaudio.PCM_PLAYBACK, params)
+        self._playback_params = params
+
+    def write(self, data):
+        self._playback.write(data)
+
+    # Blocks for up to one period. A negative length means the capture buffer overran; nothing usable is returned for that period.
+    def read(self):
+        length, data = self._capture.read()
+        return data if length > 0 else b""
+
+# Fake backend that stands in for a sound card. Played frames are written to playback_path and captured frames are read from capture_path,
+# either of which can be a regular file or a named pipe. Reads and writes are paced at the real sample rate so that timing behaves like real
+# hardware. If capture_path is None or runs out, silence is captured instead.
+class FileBackend():
+    def __init__(self, playback_path=os.devnull, capture_path=None, realtime=True):
+        self._playback_path = playback_path
+        self._capture_path = capture_path
+        self._realtime = realtime
+        self._playback = None
+        self._playback_params = (sample_rate, channels, sample_width)
+        self._capture = None
+        self._next_write = None
+        self._next_read = None
+
+    def __str__(self):
+        return "file device (playback=%s, capture=%s)" % (self._playback_path, self._capture_path)
+
+    def open(self):
+        self._playback = open(self._playback_path, "wb", buffering=0)
+        if self._capture_path:
+            self._capture = open(self._capture_path, "rb", buffering=0)
+
+    def close(self):
+        for f in (self._playback, self._capture):
+            if f: f.close()
+        self._playback = self._capture = None
+
+    def reopen_capture(self):
+        if self._capture: self._capture.close()
+        self._capture = open(self._capture_path, "rb", buffering=0) if self._capture_path else None
+
+    def set_playback_format(self, params):
+        self._playback_params = params
+
+    # Wait for the previously written audio to be 'played' before accepting more, so that the first write after idling returns immediately
+    def write(self, data):
+        self._next_write = self._pace(self._next_write, 0)
+        self._playback.write(data)
+        rate, nchannels, width = self._playback_params
+        if self._next_write is not None: self._next_write += len(data) / (rate * nchannels * width)
+
+    def read(self):
+        period_bytes = period_frames * frame_bytes
+        data = self._capture.read(period_bytes) if self._capture else b""
+        if len(data) < period_bytes: data += bytes(period_bytes - len(data))
+        self._next_read = self._pace(self._next_read, period_frames / sample_rate)
+        return data
+
+    # Sleep until the given duration of audio would have been consumed by a real device. Returns the new deadline.
+    def _pace(self, deadline, duration):
+        if not self._realtime: return None
+        now = monotonic()
+        if deadline is None or deadline < now - 0.1: deadline = now # Don't try to catch up after being idle
+        deadline += duration
+        if deadline > now: sleep(deadline - now)
+        return deadline
+
+# In-process audio engine. It keeps the backend's PCMs open for the life of the program and streams frames in and out from Python threads,
+# replacing the aplay/arecord processes that used to be spawned for every call. A single capture pump thread reads from the device
+# continuously and hands the frames to whichever sink is attached, so a recording starts on the very next period. Files passed to preload()
+# (i.e. the greeting) are held in memory and the playback PCM is left configured for them, so the greeting starts without touching the disk.
+# If reading from the capture device fails the pump keeps trying to reopen it, backing off between attempts, and capture() raises
+# AudioDeviceError for any capture that was running at the time or starts before the device is back.
+class AudioEngine():
+    def __init__(self, backend):
+        self._logger = logging.getLogger("Audio Engine")
+        self._backend = backend
+        self._sink = None
+        self._sink_lock = Lock()
+        self._running = Event()
+        self._closing = Event()
+        self._capture_error = None # Why the capture device can't be read from, while the pump is waiting to reopen it
+        self._capture_failures = 0 # How many times reading from the capture device has failed, so a capture can tell it lost frames
+        self._pump_thread = None
+        self._play_lock = Lock()
+        self._preloaded = {}
+        self._default_params = None
+
+    def open(self):
+        self._logger.info("Opening %s" % self._backend)
+        self._backend.open()
+        self._closing.clear()
+        self._running.set()
+        self._pump_thread = Thread(target=self._capture_pump, name="Capture Pump", daemon=True)
+        self._pump_thread.start()
+
+    def close(self):
+        self._running.clear()
+        self._closing.set()
+        if self._pump_thread: self._pump_thread.join()
+        self._backend.close()
+        self._logger.info("Closed %s" % self._backend)
+
+    # The sink is called with the lock held, so once capture() has detached it the sink is never called again and can be closed. A sink that
+    # raises is detached and logged rather than stopping the pump, which would leave every later recording silent.
+    def _capture_pump(self):
+        while self._running.is_set():
+            try:
+                data = self._backend.read()
+            except Exception as err:
+                self._recover_capture(err)
+                continue
+            with self._sink_lock:
+                if not (self._sink and data): continue
+                try:
+                    self._sink(data)
+                except Exception as err:
+                    self._logger.error("Capture sink failed and was detached: %s: %s" % (type(err).__name__, err))
+                    self._sink = None
+
+    # Detach the sink of the capture the failure interrupted, then try to reopen the capture device until it works or the engine is closed
+    def _recover_capture(self, err):
+        self._logger.error("Reading from the capture device failed: %s: %s" % (type(err).__name__, err))
+        with self._sink_lock:
+            self._capture_error = err
+            self._capture_failures += 1
+            self._sink = None
+        delay = capture_retry_s
+        while not self._closing.wait(delay):
+            try:
+                self._backend.reopen_capture()
+            except Exception as err:
+                self._logger.debug("Unable to reopen the capture device: %s: %s" % (type(err).__name__, err))
+                delay = min(delay * 2, capture_retry_max_s)
+                continue
+            self._logger.info("Reopened the capture device")
+            with self._sink_lock:
+                self._capture_error = None
+            return
+
+    # Read a WAV file into memory and configure the playback PCM for its format
+    def preload(self, audio_file):
+        with wave.open(str(audio_file), "rb") as wav:
+            params = (wav.getframerate(), wav.getnchannels(), wav.getsampwidth())
+            frames = wav.readframes(wav.getnframes())
+        with self._play_lock:
+            self._backend.set_playback_format(params)
+        self._preloaded[str(audio_file)] = (params, frames)
+        self._default_params = params
+        self._logger.debug("Preloaded %s (%d bytes)" % (audio_file, len(frames)))
+
+    # Stream a WAV file to the playback PCM until it ends or the stop event is set. Returns 0 if the file played to the end and 1 if it was
+    # interrupted, mirroring the return codes of the process based runner. audio_file can also be a binary file object producing a WAV stream,
+    # such as the stdout of a decoder. If on_start is given it is called once the first period has been handed to the device.
+    def play(self, audio_file, stop, on_start=None):
+        with self._play_lock:
+            if str(audio_file) in self._preloaded:
+                params, frames = self._preloaded[str(audio_file)]
+                return self._stream(params, frames, stop, on_start=on_start)
+            try:
+                with wave.open(audio_file if hasattr(audio_file, "read") else str(audio_file), "rb") as wav:
+                    params = (wav.getframerate(), wav.getnchannels(), wav.getsampwidth())
+                    return self._stream(params, None, stop, on_start=on_start, wav=wav)
+            finally:
+                # Put the playback PCM back the way the preloaded greeting needs it so that the next call doesn't pay for reopening it
+                if self._default_params: self._backend.set_playback_format(self._default_params)
+
+    def _stream(self, params, frames, stop, on_start=None, wav=None):
+        self._backend.set_playback_format(params)
+        period_bytes = period_frames * params[1] * params[2]
+        offset = 0
+        while not stop.is_set():
+            if wav:
+                data = wav.readframes(period_frames)
+            else:
+                data = frames[offset:offset + period_bytes]
+                offset += period_bytes
+            if not data: return 0
+            self._backend.write(data)
+            if on_start:
+                on_start()
+                on_start = None
+        return 1
+
+    # Attach the given sink callable to the capture stream until the stop event is set. The sink is called from the capture pump thread with
+    # each period of raw frames, so it must not block. Raises AudioDeviceError if the capture device is down or fails before the stop event.
+    def capture(self, sink, stop):
+        with self._sink_lock:
+            if self._capture_error: raise AudioDeviceError("The capture device is unavailable: %s" % self._capture_error)
+            if self._sink: raise RuntimeError("A capture is already in progress")
+            self._sink = sink
+            failures = self._capture_failures
+        try:
+            while not stop.wait(timeout=capture_check_s) and self._capture_failures == failures: pass
+        finally:
+            with self._sink_lock:
+                if self._sink is sink: self._sink = None
+        if self._capture_failures != failures: raise AudioDeviceError("The capture device failed during the capture")
+        return 0
@@ -0,0 +1,460 @@
+#!/usr/bin/python
+import logging, os, sys, json, random, resource, tempfile, wave, platform, subprocess
+from argparse import ArgumentParser, RawTextHelpFormatter
+from datetime import datetime
+from pathlib import Path
+from time import monotonic, sleep
+from threading import Thread, Event, active_count
+import metrics
+
+# Script constants
+this_script_path = Path(__file__).resolve()
+this_script_dir  = this_script_path.parent.resolve()
+sample_rate      = 44100
+period_frames    = 1024
+percentiles      = (50, 90, 99)
+scaling_metrics  = ("phony_recording_start_seconds", "phony_hangup_seconds") # Compared between one line and many by multi_line
+min_recorded     = 0.9  # multi_line fails if a line records less than this fraction of what a lone line records per call
+max_slowdown     = 3    # or if the p99 of a scaling metric is more than this many times a lone line's
+latency_slack_s  = 0.05 # plus this much, since a lone line's latencies are a few ms and jitter by more than that
+
+# Stand-ins for aplay and arecord. bench.py writes small 'aplay' and 'arecord' scripts into a temporary directory at the front of PATH, which
+# call back into this function. aplay consumes the WAV file (or stdin) at the real sample rate; arecord produces silent S16_LE frames at the
+# real sample rate on stdout until it is killed. Both behave like the real tools on SIGTERM.
+def fake_tool(tool, argv):
+    period_s = period_frames / sample_rate
+    deadline = monotonic()
+    if tool == "aplay":
+        files = [arg for arg in argv if not arg.startswith("-")]
+        with wave.open(files[-1] if files else sys.stdin.buffer, "rb") as wav:
+            while wav.readframes(period_frames):
+                deadline += period_s
+                sleep(max(0, deadline - monotonic()))
+    elif tool == "arecord":
+        silence = bytes(period_frames * 2)
+        try:
+            while True:
+                sys.stdout.buffer.write(silence)
+                sys.stdout.buffer.flush()
+                deadline += period_s
+                sleep(max(0, deadline - monotonic()))
+        except BrokenPipeError:
+            pass
+    else:
+        raise ValueError("Unknown tool %s" % tool)
+
+def install_fake_tools(bin_dir):
+    for tool in ("aplay", "arecord"):
+        path = Path(bin_dir, tool)
+        path.write_text("#!%s\nimport sys\nsys.path.insert(0, %r)\nimport bench\nbench.fake_tool(%r, sys.argv[1:])\n" %
+                        (sys.executable, str(this_script_dir), tool))
+        path.chmod(0o755)
+    os.environ["PATH"] = str(bin_dir) + os.pathsep + os.environ["PATH"]
+
+# Return the value of a numeric field (e.g. VmRSS) from /proc/self/status
+def proc_status(field):
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith(field + ":"): return int(line.split()[1])
+    return 0
+
+def summarize(samples):
+    if not samples: return {"count": 0}
+    samples = sorted(samples)
+    summary = {"count": len(samples), "max": samples[-1], "mean": sum(samples) / len(samples)}
+    for p in percentiles:
+        summary["p%d" % p] = samples[min(len(samples) - 1, int(round(p / 100 * (len(samples) - 1))))]
+    return summary
+
+# Samples the process' memory, thread and file descriptor counts in the background while a scenario runs
+class ResourceSampler():
+    def __init__(self, interval_s=0.05):
+        self._interval_s = interval_s
+        self._stop = Event()
+        self._thread = Thread(target=self._run, name="Resource Sampler", daemon=True)
+        self.peaks = {"rss_kb": 0, "threads": 0, "fds": 0}
+
+    def sample(self):
+        sample = {"rss_kb": proc_status("VmRSS"), "threads": active_count(), "fds": len(os.listdir("/proc/self/fd"))}
+        for key, value in sample.items():
+            if value > self.peaks[key]: self.peaks[key] = value
+        return sample
+
+    def _run(self):
+        while not self._stop.wait(self._interval_s):
+            self.sample()
+
+    def start(self):
+        self._start_sample = self.sample()
+        self._start_usage = (resource.getrusage(resource.RUSAGE_SELF), resource.getrusage(resource.RUSAGE_CHILDREN))
+        self._start_time = monotonic()
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        wall_s = monotonic() - self._start_time
+        end_sample = self.sample()
+        self_usage, child_usage = resource.getrusage(resource.RUSAGE_SELF), resource.getrusage(resource.RUSAGE_CHILDREN)
+        cpu_s = lambda end, start: (end.ru_utime + end.ru_stime) - (start.ru_utime + start.ru_stime)
+        return {
+            "wall_s": wall_s,
+            "cpu_percent": 100 * cpu_s(self_usage, self._start_usage[0]) / wall_s,
+            "children_cpu_percent": 100 * cpu_s(child_usage, self._start_usage[1]) / wall_s,
+            "rss_kb_start": self._start_sample["rss_kb"], "rss_kb_end": end_sample["rss_kb"], "rss_kb_peak": self.peaks["rss_kb"],
+            "threads_start": self._start_sample["threads"], "threads_end": end_sample["threads"], "threads_peak": self.peaks["threads"],
+            "fds_start": self._start_sample["fds"], "fds_end": end_sample["fds"], "fds_peak": self.peaks["fds"],
+            "fds_leaked": end_sample["fds"] - self._start_sample["fds"],
+        }
+
+# Keeps every observed latency as well as updating the normal histograms
+class SampleRegistry(metrics.Registry):
+    def __init__(self):
+        super().__init__()
+        self.samples = {}
+
+    def observe(self, name, value, labels):
+        super().observe(name, value, labels)
+        self.samples.setdefault(name + "".join("{%s=%s}" % label for label in labels), []).append(value)
+
+    def counters(self):
+        with self._lock:
+            return {key: value for key, value in self._values.items() if metrics.definitions[key[0]][0] == "counter"}
+
+# Wires up the real phony call path (a LineManager with a Line for each handset, each with its own Phone and RecordingIndex) to gpiozero
+# mock pins and a fake sound card, so that scenarios can lift and replace the handsets by driving the pins. A single line uses the default pins;
+# with more than one, line n uses GPIO 2n and 2n + 1 and records to its own subdirectory of out_dir.
+class Harness():
+    def __init__(self, out_dir, backend, line_count=1):
+        import lines
+        from gpiozero.pins.mock import MockFactory
+
+        self.out_dir = out_dir
+        self.backend = backend
+        greeting = str(Path(this_script_dir, "greeting.wav"))
+        if line_count == 1:
+            configs = [lines.line_config(out_dir=str(out_dir), greeting=greeting)]
+        else:
+            configs = [lines.line_config(name=n, hook_pin=2 * n, chord_pin=2 * n + 1, playback_device="fake%d" % n, capture_device="fake%d" % n,
+                                         out_dir=str(Path(out_dir, "line%d" % n)), greeting=greeting) for n in range(1, line_count + 1)]
+        self.line_manager = lines.LineManager(configs, audio_backend="file" if backend == "engine" else "process")
+        self.factory = MockFactory()
+        start = monotonic()
+        self.line_manager.open(pin_factory=self.factory)
+        self.open_s = monotonic() - start
+        self.line_count = len(self.line_manager.lines)
+        self.hook_pins = [self.factory.pin(config["hook_pin"]) for config in configs]
+        self.chord_pins = [self.factory.pin(config["chord_pin"]) for config in configs]
+        self.debounce_s = max(configs[0]["hook_debounce_s"], configs[0]["chord_debounce_s"])
+
+    # The buttons are pulled up, so driving a pin low is the same as the switch closing
+    def pickup(self, line=0):
+        self.hook_pins[line].drive_low()
+
+    def hangup(self, line=0):
+        self.hook_pins[line].drive_high()
+
+    def chord(self, hold_s=0.1, line=0):
+        self.chord_pins[line].drive_low()
+        sleep(hold_s)
+        self.chord_pins[line].drive_high()
+
+    def call(self, duration_s, line=0):
+        self.pickup(line)
+        sleep(duration_s)
+        self.hangup(line)
+        sleep(self.debounce_s) # Let the debounce window pass so the next edge isn't swallowed
+
+    def close(self):
+        self.line_manager.close()
+        self.factory.close()
+
+# Scenarios. Each one is given a Harness and the parsed arguments and drives the pins; the latencies come from the phony metrics. A scenario
+# can return a dict of its own results to add to the standard ones.
+def scenario_back_to_back(harness, args):
+    for _ in range(args.calls):
+        harness.call(args.call_s)
+
+def scenario_bounce_storm(harness, args):
+    rng = random.Random(args.seed)
+    for i in range(args.bounces):
+        harness.pickup() if i % 2 == 0 else harness.hangup()
+        sleep(rng.uniform(0.002, 0.06))
+    harness.hangup()
+    sleep(harness.debounce_s)
+    harness.call(args.call_s) # Make sure the phone still works after the storm
+
+def scenario_long_call(harness, args):
+    harness.call(args.long_s)
+
+def scenario_big_archive(harness, args):
+    for _ in range(args.calls):
+        harness.call(args.call_s)
+
+def scenario_replay(harness, args):
+    for _ in range(3):
+        harness.call(args.call_s)
+    for _ in range(args.calls):
+        harness.pickup()
+        sleep(0.2)
+        harness.chord()
+        sleep(args.call_s)
+        harness.hangup()
+        sleep(harness.debounce_s)
+
+# Every line takes calls back to back at the same time, after the same calls have been made on a lone line in a harness of its own. Lines that
+# really run in parallel record as much of each call as the lone line does and start and stop recording as quickly; if they were handled one
+# after another the later lines would lose the start of their calls and wait for the others. The scenario fails if any line records less than
+# min_recorded of what the lone line did per call, or the p99 of a scaling metric is more than max_slowdown times the lone line's.
+def scenario_multi_line(harness, args):
+    registry = metrics.registry
+    metrics.registry = SampleRegistry()
+    lone = Harness(out_dir=Path(harness.out_dir, "lone"), backend=harness.backend)
+    try:
+        run_lines(lone, args)
+        lone_result = scaling_result(lone, metrics.registry)
+    finally:
+        lone.close()
+        metrics.registry = registry
+
+    wall_s = run_lines(harness, args)
+    recorded = [len(line.recording_index.recent(args.calls * 2)) for line in harness.line_manager.lines]
+    result = scaling_result(harness, registry)
+    result.update({"lines": harness.line_count, "calls_per_s": harness.line_count * args.calls / wall_s, "lone": lone_result,
+                   "recordings_per_line_min": min(recorded), "recordings_per_line_max": max(recorded)})
+    check_lines(harness, args.calls)
+    problems = []
+    if result["recorded_s_per_call"] < min_recorded * lone_result["recorded_s_per_call"]:
+        problems.append("a line recorded %.2f s per call against %.2f s on a lone line" % (result["recorded_s_per_call"],
+                                                                                          lone_result["recorded_s_per_call"]))
+    for metric in scaling_metrics:
+        if result[metric] > max_slowdown * lone_result[metric] + latency_slack_s:
+            problems.append("%s p99 is %.1f ms against %.1f ms on a lone line" % (metric, result[metric] * 1000, lone_result[metric] * 1000))
+    if problems: raise ScenarioFailed("; ".join(problems))
+    return result
+
+# Make the given number of calls on every line of the harness at once. Returns how long they took.
+def run_lines(harness, args):
+    start = monotonic()
+    threads = [Thread(target=lambda line=line: [harness.call(args.call_s, line=line) for _ in range(args.calls)]) for line in range(harness.line_count)]
+    for thread in threads: thread.start()
+    for thread in threads: thread.join()
+    wall_s = monotonic() - start
+    sleep(0.5) # Let the last hangups be handled before counting the recordings
+    return wall_s
+
+# Return the least audio any line of the harness recorded per call and the p99 of each scaling metric
+def scaling_result(harness, registry):
+    recorded = [sum(row["duration"] or 0 for row in rows) / len(rows) if rows else 0
+                for rows in (line.recording_index.recent(1000) for line in harness.line_manager.lines)]
+    result = {"recorded_s_per_call": min(recorded)}
+    for metric in scaling_metrics: result[metric] = summarize(registry.samples.get(metric, [])).get("p99", 0)
+    return result
+
+# Raised by a scenario whose checks fail. The run carries on with the other scenarios and exits with an error at the end.
+class ScenarioFailed(Exception):
+    pass
+
+# Check that every line recorded exactly its own calls: the given number of complete recordings, numbered from 1 and all in its own
+# directory. Raises ScenarioFailed if not.
+def check_lines(harness, calls):
+    from recordings import STATUS_COMPLETE
+    problems = []
+    for line in harness.line_manager.lines:
+        rows = line.recording_index.recent(calls * 2)
+        if sorted(row["seq"] for row in rows) != list(range(1, calls + 1)):
+            problems.append("line %s has recordings %s instead of 1-%d" % (line.name, sorted(row["seq"] for row in rows), calls))
+        problems += ["line %s recording %d is %s" % (line.name, row["seq"], row["status"]) for row in rows if row["status"] != STATUS_COMPLETE]
+        problems += ["line %s recording %d is in %s" % (line.name, row["seq"], Path(row["path"]).parent) for row in rows
+                     if Path(row["path"]).parent != Path(line.config["out_dir"]).resolve()]
+        problems += ["line %s recording %d is missing" % (line.name, row["seq"]) for row in rows if not os.path.exists(row["path"])]
+    if problems: raise ScenarioFailed("; ".join(problems))
+
+# Return the edge trace to replay as a list of (time, line name, edge), either read from the --trace file written by phony.py --trace-edges or,
+# without one, made up of calls whose every pickup and hangup bounces a few times, with the odd double-pressed chord and stray hangup
+def load_trace(args):
+    import lines
+    if args.trace:
+        with open(args.trace) as f:
+            return [(float(t), line, edge) for t, line, edge in (row.split() for row in f if row.strip()) if edge in lines.edges]
+    rng = random.Random(args.seed)
+    trace, t = [], 0.0
+    def bouncy(edge, other):
+        nonlocal t
+        for _ in range(rng.randrange(0, 4)):
+            trace.extend([(t, "1", edge), (t + 0.002, "1", other)])
+            t += rng.uniform(0.003, 0.02)
+        trace.append((t, "1", edge))
+    for i in range(args.calls):
+        bouncy(lines.EDGE_HOOK_UP, lines.EDGE_HOOK_DOWN)
+        if i % 3 == 2: trace.extend([(t + 0.5, "1", lines.EDGE_CHORD), (t + 0.55, "1", lines.EDGE_CHORD)])
+        t += args.call_s
+        bouncy(lines.EDGE_HOOK_DOWN, lines.EDGE_HOOK_UP)
+        t += 1.0
+        if i % 4 == 3: trace.append((t - 0.5, "1", lines.EDGE_HOOK_DOWN))
+    return sorted(trace)
+
+# Feed an edge trace straight into the lines' queues with its original timing, bypassing the pins so that the edges reach the call state
+# machines exactly as they were recorded. Gaps longer than --max-gap-s (such as the time between calls, or a restart of phony) are shortened.
+def scenario_trace(harness, args):
+    trace = load_trace(args)
+    names = list(dict.fromkeys(line for _, line, _ in trace))
+    lines_by_name = {name: harness.line_manager.lines[i] for i, name in enumerate(names)}
+    start, offset, last, lag = monotonic(), 0.0, trace[0][0] if trace else 0.0, []
+    for t, name, edge in trace:
+        offset += min(max(0.0, t - last), args.max_gap_s)
+        last = t
+        delay = start + offset - monotonic()
+        if delay > 0: sleep(delay)
+        lag.append(monotonic() - (start + offset))
+        lines_by_name[name].post(edge, edge_time=start + offset)
+    sleep(1) # Let the last edges be handled
+    return {"edges": len(trace), "post_lag_s": summarize(lag), "states": {line.name: line.state for line in harness.line_manager.lines}}
+
+scenarios = {
+    "back_to_back": scenario_back_to_back,
+    "bounce_storm": scenario_bounce_storm,
+    "long_call":    scenario_long_call,
+    "big_archive":  scenario_big_archive,
+    "replay":       scenario_replay,
+    "multi_line":   scenario_multi_line,
+    "trace":        scenario_trace,
+}
+
+# Fill out_dir with empty recordings so that startup and pickup run against a large archive
+def populate_archive(out_dir, count):
+    header = None
+    for seq in range(1, count + 1):
+        path = Path(out_dir, "%d_Recording_01Jan24-000000.wav" % seq)
+        if header is None:
+            with wave.open(str(path), "wb") as wav:
+                wav.setnchannels(1)
+                wav.setsampwidth(2)
+                wav.setframerate(sample_rate)
+            header = path.read_bytes()
+        else:
+            path.write_bytes(header)
+
+def run_scenario(name, args, work_dir):
+    out_dir = Path(work_dir, name)
+    out_dir.mkdir()
+    if name == "big_archive": populate_archive(out_dir, args.archive_size)
+
+    # Swap in a registry that keeps every latency sample so that percentiles can be computed
+    registry = SampleRegistry()
+    metrics.registry = registry
+
+    sampler = ResourceSampler()
+    sampler.start()
+    line_count = 1
+    if name == "multi_line": line_count = args.lines
+    if name == "trace": line_count = len({line for _, line, _ in load_trace(args)})
+    harness = Harness(out_dir=out_dir, backend=args.backend, line_count=line_count)
+    try:
+        extra = scenarios[name](harness, args)
+    except ScenarioFailed as err:
+        extra = {"failed": str(err)}
+    finally:
+        harness.close()
+    sleep(0.2) # Give exiting threads a moment to be reaped before the final sample
+    result = sampler.stop()
+    result["open_s"] = harness.open_s
+    result.update(extra or {})
+    result["latency_s"] = {metric: summarize(samples) for metric, samples in sorted(registry.samples.items())}
+    result["counters"] = {"%s%s" % (metric, "".join("{%s=%s}" % label for label in labels)): value
+                          for (metric, labels), value in sorted(registry.counters().items())}
+    return result
+
+def print_result(name, result):
+    print("\n%s (%.1f s)" % (name, result["wall_s"]))
+    for metric, summary in result["latency_s"].items():
+        if not summary["count"]: continue
+        print("  %-36s n=%-5d p50=%8.2f ms  p90=%8.2f ms  p99=%8.2f ms  max=%8.2f ms" %
+              (metric, summary["count"], summary["p50"] * 1000, summary["p90"] * 1000, summary["p99"] * 1000, summary["max"] * 1000))
+    print("  cpu %.1f%% (children %.1f%%), rss peak %d kB, threads peak %d (end %d), fds peak %d (leaked %d), open %.1f ms" %
+          (result["cpu_percent"], result["children_cpu_percent"], result["rss_kb_peak"], result["threads_peak"], result["threads_end"],
+           result["fds_peak"], result["fds_leaked"], result["open_s"] * 1000))
+    if "failed" in result:
+        print("  FAILED: %s" % result["failed"])
+    elif "lines" in result:
+        print("  %d lines: %.2f calls/s, %d-%d recordings per line, %.2f s recorded per call (lone line %.2f s)" %
+              (result["lines"], result["calls_per_s"], result["recordings_per_line_min"], result["recordings_per_line_max"],
+               result["recorded_s_per_call"], result["lone"]["recorded_s_per_call"]))
+        for metric in scaling_metrics:
+            print("  %-36s p99=%8.2f ms  lone line p99=%8.2f ms" % (metric, result[metric] * 1000, result["lone"][metric] * 1000))
+
+# Flatten a results file into {"scenario.path.to.value": number}
+def flatten(obj, prefix=""):
+    if isinstance(obj, dict):
+        flat = {}
+        for key, value in obj.items(): flat.update(flatten(value, prefix + "." + str(key) if prefix else str(key)))
+        return flat
+    return {prefix: obj} if isinstance(obj, (int, float)) and not isinstance(obj, bool) else {}
+
+# Print every numeric value that appears in both results files along with the change between them
+def compare(baseline_path, current_path):
+    baseline = flatten(json.loads(Path(baseline_path).read_text())["scenarios"])
+    current = flatten(json.loads(Path(current_path).read_text())["scenarios"])
+    print("%-70s %14s %14s %9s" % ("metric", "baseline", "current", "change"))
+    for key in sorted(baseline.keys() & current.keys()):
+        old, new = baseline[key], current[key]
+        change = "%+8.1f%%" % (100 * (new - old) / old) if old else ""
+        print("%-70s %14.6g %14.6g %9s" % (key, old, new, change))
+
+# Parse script input arguments.
+def parse_args():
+    desc_str = ("Runs the phony call path against mock GPIO pins and a fake sound card and reports latency and resource usage\n\n")
+    parser = ArgumentParser(formatter_class=RawTextHelpFormatter, description=desc_str)
+    parser.add_argument("-s", "--scenario", action="append", choices=list(scenarios), help="Scenario to run. Can be given more than once\n"
+                                                                                           "(default=all of them)")
+    parser.add_argument("-b", "--backend", choices=["process", "engine"], default="process", help="'process' runs the fake aplay/arecord,\n"
+                                                                                                  "'engine' uses the audio engine with a fake device (default=%(default)s)")
+    parser.add_argument("-o", "--output", type=str, default=None, help="Write the results to this JSON file")
+    parser.add_argument("--compare", nargs=2, metavar=("BASELINE", "CURRENT"), help="Compare two results files instead of running")
+    parser.add_argument("--calls", type=int, default=10, help="Number of calls in the multi-call scenarios (default=%(default)s)")
+    parser.add_argument("--call-s", type=float, default=2, help="Length of each call in seconds (default=%(default)s)")
+    parser.add_argument("--long-s", type=float, default=60, help="Length of the long call in seconds (default=%(default)s)")
+    parser.add_argument("--bounces", type=int, default=200, help="Number of edges in the bounce storm (default=%(default)s)")
+    parser.add_argument("--archive-size", type=int, default=5000, help="Number of existing recordings for big_archive (default=%(default)s)")
+    parser.add_argument("--lines", type=int, default=8, choices=range(1, 14), metavar="1-13", help="Number of handsets in the multi_line scenario\n"
+                                                                                                 "(default=%(default)s)")
+    parser.add_argument("--trace", type=str, default=None, help="Edge trace written by phony.py --trace-edges for the trace scenario\n"
+                                                                "(default=a made up trace of bouncy calls)")
+    parser.add_argument("--max-gap-s", type=float, default=10, help="Longest gap between edges when replaying a trace (default=%(default)s)")
+    parser.add_argument("--seed", type=int, default=1, help="Random seed for the bounce storm and the made up trace\n(default=%(default)s)")
+    parser.add_argument("--debug", action="store_true", help="If specified, log messages at DEBUG level and higher will be printed to the console")
+    return parser.parse_args()
+
+if (__name__ == "__main__"):
+    args = parse_args()
+    if args.compare:
+        compare(*args.compare)
+        exit()
+
+    import util
+    util.init_logging(console_level=(logging.DEBUG if args.debug else logging.WARNING))
+
+    results = {"meta": {"time": datetime.now().isoformat(), "backend": args.backend, "python": platform.python_version(),
+                        "host": platform.node(), "args": vars(args)},
+               "scenarios": {}}
+    try:
+        results["meta"]["git"] = subprocess.run(["git", "-C", str(this_script_dir), "rev-parse", "--short", "HEAD"], capture_output=True,
+                                                text=True).stdout.strip()
+    except OSError:
+        pass
+
+    with tempfile.TemporaryDirectory(prefix="phony_bench_") as work_dir:
+        bin_dir = Path(work_dir, "bin")
+        bin_dir.mkdir()
+        install_fake_tools(bin_dir)
+        for name in args.scenario or list(scenarios):
+            results["scenarios"][name] = run_scenario(name, args, work_dir)
+            print_result(name, results["scenarios"][name])
+
+    if args.output:
+        Path(args.output).write_text(json.dumps(results, indent=2) + "\n")
+        print("\nResults written to %s" % args.output)
+    failed = [name for name, result in results["scenarios"].items() if "failed" in result]
+    if failed:
+        print("\nFailed: %s" % ", ".join(failed))
+        exit(1)
@@ -0,0 +1,144 @@
+#!/usr/bin/python
+import logging, os, shutil, shlex, tempfile, wave
+from argparse import ArgumentParser, RawTextHelpFormatter
+from subprocess import Popen, PIPE, DEVNULL, run
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from time import monotonic
+from pathlib import Path
+import audio
+
+# Commands for each supported compressed format. 'stream' encodes raw capture frames from stdin, 'file' encodes an existing WAV file and
+# 'decode' writes a WAV stream to stdout. The encoders themselves (the 'flac' and 'opus-tools' packages) do the heavy lifting in their own
+# processes, so compression never runs on a capture thread and a pool of them can use every core.
+raw_fmt = {"rate": audio.sample_rate, "channels": audio.channels, "bits": audio.sample_width * 8}
+formats = {
+    "flac": {
+        "stream": "flac --silent --force-raw-format --endian=little --sign=signed --channels={channels} --bps={bits} --sample-rate={rate} -o {out} -",
+        "file":   "flac --silent -o {out} {src}",
+        "decode": "flac --silent --decode --stdout {src}",
+    },
+    "opus": {
+        "stream": "opusenc --quiet --raw --raw-bits={bits} --raw-rate={rate} --raw-chan={channels} --raw-endianness=0 - {out}",
+        "file":   "opusenc --quiet {src} {out}",
+        "decode": "opusdec --quiet {src} -",
+    },
+}
+
+# Build the argument list for one of the commands above. The template is split before the paths are substituted so that paths containing
+# spaces stay as single arguments.
+def command(fmt, kind, **fields):
+    return [arg.format(**fields) for arg in shlex.split(formats[fmt][kind])]
+
+# Return True if the given recording is in one of the compressed formats (and so must be decoded before it can be played)
+def is_compressed(path):
+    return Path(path).suffix[1:] in formats
+
+# Start a decoder for a compressed recording. The returned Popen object's stdout is a WAV stream.
+def open_decoder(path):
+    cmd = command(Path(path).suffix[1:], "decode", src=path)
+    return Popen(cmd, stdout=PIPE, stderr=DEVNULL)
+
+# Recorder output that streams raw capture frames into an encoder process, for use with recorder.BufferedRecorder. The recorder's writer
+# thread is the only thing that writes to the encoder's stdin, so if the encoder falls behind the backlog builds up in the recorder's ring
+# buffer instead of stalling capture.
+class EncoderPipe():
+    def __init__(self, path, fmt):
+        self._logger = logging.getLogger("Encoder")
+        cmd = command(fmt, "stream", out=path, **raw_fmt)
+        self._logger.debug("Starting encoder '%s'" % " ".join(cmd))
+        self._proc = Popen(cmd, stdin=PIPE, stdout=DEVNULL, stderr=PIPE)
+
+    def write(self, data):
+        self._proc.stdin.write(data)
+
+    def sync(self):
+        self._proc.stdin.flush()
+
+    # Close the encoder's input and wait for it to write out the rest of the file
+    def close(self):
+        self._proc.stdin.close()
+        ret_code = self._proc.wait()
+        errors = self._proc.stderr.read().decode(errors="replace").strip()
+        self._proc.stderr.close()
+        if ret_code != 0:
+            raise Exception("Encoder exited with return code %d: %s" % (ret_code, errors))
+
+# Encode a single WAV file. Returns (duration in seconds, source size, encoded size).
+def encode_file(src, out, fmt):
+    cmd = command(fmt, "file", src=src, out=out)
+    result = run(cmd, stdout=DEVNULL, stderr=PIPE)
+    if result.returncode != 0:
+        raise Exception("'%s' exited with return code %d: %s" % (" ".join(cmd), result.returncode, result.stderr.decode(errors="replace").strip()))
+    with wave.open(str(src), "rb") as wav:
+        duration = wav.getnframes() / wav.getframerate()
+    return duration, os.path.getsize(src), os.path.getsize(out)
+
+# Convert every finished WAV recording in out_dir's recording index to the given format using a pool of encoder processes, one per core by
+# default. Recordings come from the index rather than a directory listing so that the one phony may be recording right now is never touched.
+# The converted file replaces the WAV and the recording index is updated unless benchmark is set, in which case the encoded files are written to
+# a temporary directory and thrown away. Returns a dict of throughput and compression statistics.
+def convert_archive(logger, out_dir, fmt, recording_index, jobs=None, benchmark=False):
+    rows = [row for row in recording_index.stored() if not row["archive"] and row["path"].endswith(".wav") and os.path.exists(row["path"])]
+    jobs = jobs or os.cpu_count()
+    logger.info("Converting %d recordings in %s to %s using %d jobs" % (len(rows), out_dir, fmt, jobs))
+
+    with tempfile.TemporaryDirectory(dir=out_dir) as tmp_dir:
+        stats = {"files": 0, "failed": 0, "audio_s": 0.0, "src_bytes": 0, "out_bytes": 0}
+        start = monotonic()
+        with ThreadPoolExecutor(max_workers=jobs) as pool:
+            futures = {pool.submit(encode_file, row["path"], Path(tmp_dir, Path(row["path"]).stem + "." + fmt), fmt): row for row in rows}
+            for future in as_completed(futures):
+                seq, src = futures[future]["seq"], Path(futures[future]["path"])
+                try:
+                    duration, src_bytes, out_bytes = future.result()
+                except Exception as err:
+                    logger.error("Unable to convert %s: %s" % (src, err))
+                    stats["failed"] += 1
+                    continue
+                stats["files"] += 1
+                stats["audio_s"] += duration
+                stats["src_bytes"] += src_bytes
+                stats["out_bytes"] += out_bytes
+                if benchmark: continue
+
+                # Move the encoded file into place before deleting the WAV so that a crash never loses the recording
+                out = src.with_suffix("." + fmt)
+                os.replace(Path(tmp_dir, out.name), out)
+                recording_index.set_path(seq, out.resolve())
+                os.remove(src)
+        stats["wall_s"] = monotonic() - start
+
+    stats["realtime_factor"] = stats["audio_s"] / stats["wall_s"] if stats["wall_s"] else 0
+    stats["mb_per_s"] = stats["src_bytes"] / stats["wall_s"] / 1e6 if stats["wall_s"] else 0
+    stats["compression_ratio"] = stats["src_bytes"] / stats["out_bytes"] if stats["out_bytes"] else 0
+    logger.info("Converted %d files (%d failed): %.1f s of audio in %.2f s (%.1fx realtime, %.1f MB/s), %.1f MB -> %.1f MB (ratio %.2f)" %
+                (stats["files"], stats["failed"], stats["audio_s"], stats["wall_s"], stats["realtime_factor"], stats["mb_per_s"],
+                 stats["src_bytes"] / 1e6, stats["out_bytes"] / 1e6, stats["compression_ratio"]))
+    return stats
+
+# Parse script input arguments.
+def parse_args():
+    desc_str = ("Batch converts the WAV recordings in the output directory to a compressed format\n\n")
+    parser = ArgumentParser(formatter_class=RawTextHelpFormatter, description=desc_str)
+    parser.add_argument("out_dir", type=str, help="The directory containing the recordings")
+    parser.add_argument("-f", "--format", choices=list(formats), default="flac", help="The format to convert to (default=%(default)s)")
+    parser.add_argument("-j", "--jobs", type=int, default=os.cpu_count(), help="The number of encoders to run in parallel (default=%(default)s)")
+    parser.add_argument("--benchmark", action="store_true", help="If specified, encode to a temporary directory and report the throughput and\n"
+                                                                 "compression ratio without changing the recordings")
+    parser.add_argument("--debug", action="store_true", help="If specified, log messages at DEBUG level and higher will be printed to the console")
+    return parser.parse_args()
+
+if (__name__ == "__main__"):
+    import util
+    args = parse_args()
+    util.init_logging(console_level=(logging.DEBUG if args.debug else logging.INFO))
+    logger = logging.getLogger(name=Path(__file__).name)
+    if not shutil.which(command(args.format, "file", src="", out="")[0]):
+        logger.critical("The %s encoder is not installed" % args.format)
+        exit(1)
+
+    from recordings import RecordingIndex
+    recording_index = RecordingIndex(out_dir=args.out_dir)
+    recording_index.open(recover=False) # phony may be running and recording into the same directory
+    convert_archive(logger, args.out_dir, args.format, recording_index, jobs=args.jobs, benchmark=args.benchmark)
+    recording_index.close()
@@ -0,0 +1,326 @@
+import logging, json, queue
+from time import monotonic
+from threading import Thread
+from pathlib import Path
+import metrics, storage
+from phone import Phone
+from recordings import RecordingIndex
+from audio import AudioEngine, AlsaBackend, FileBackend
+
+# Settings for each line, with the defaults being the pins and sound card of the original single handset. A line configuration file is
+# JSON of the form {"lines": [{"name": "kitchen", "hook_pin": 14, ...}, ...]} where each line sets whichever of these it needs to.
+line_defaults = {
+    "hook_pin":         14,
+    "hook_debounce_s":  0.2,
+    "chord_pin":        12,
+    "chord_debounce_s": 1,
+    "playback_device":  "plughw:1,0",
+    "capture_device":   "plughw:1,0",
+    "out_dir":          "out",
+    "greeting":         "greeting.wav",
+}
+
+# Return the settings of a single line, filling in the defaults
+def line_config(name="1", **settings):
+    unknown = set(settings) - set(line_defaults)
+    if unknown: raise ValueError("Unknown settings for line %s: %s" % (name, ", ".join(sorted(unknown))))
+    return dict(line_defaults, name=str(name), **settings)
+
+# Load a line configuration file. Relative paths in it are taken to be relative to the file. Lines can't share pins, sound cards or output
+# directories, since each has its own recording sequence.
+def load_config(path):
+    with open(path) as f:
+        entries = json.load(f)["lines"]
+    configs = []
+    for number, entry in enumerate(entries, start=1):
+        entry = dict(entry)
+        config = line_config(name=entry.pop("name", number), **entry)
+        for key in ("out_dir", "greeting"): config[key] = str(Path(Path(path).parent, config[key]).resolve())
+        configs.append(config)
+    for keys in (("name", ), ("hook_pin", "chord_pin"), ("playback_device", ), ("capture_device", ), ("out_dir", )):
+        values = [config[key] for config in configs for key in keys]
+        duplicates = sorted(set(str(value) for value in values if values.count(value) > 1))
+        if duplicates: raise ValueError("Lines in %s share the same %s: %s" % (path, "/".join(keys), ", ".join(duplicates)))
+    return configs
+
+# Create the in-process audio engine and open the sound card so that it is ready before the first call. Returns None if the 'process' backend
+# was requested or the engine can't be started, in which case the Phone falls back to spawning aplay/arecord. The 'file' backend plays to
+# /dev/null and records silence, for running without a sound card.
+def create_audio_engine(logger, backend, config):
+    if backend == "process":
+        return None
+    engine = AudioEngine(FileBackend() if backend == "file" else AlsaBackend(device=config["playback_device"], capture_device=config["capture_device"]))
+    try:
+        engine.open()
+        engine.preload(config["greeting"])
+    except Exception as err:
+        try:
+            engine.close() # Frees the sound card for aplay/arecord
+        except Exception:
+            pass
+        logger.warning("Unable to start the audio engine (%s: %s). Falling back to aplay/arecord" % (type(err).__name__, err))
+        return None
+    return engine
+
+# Return a callback that records the time since edge_time in the given latency histogram, or None if metrics are disabled
+def latency_observer(name, edge_time):
+    if metrics.registry is None: return None
+    return lambda: metrics.observe(name, monotonic() - edge_time)
+
+# Call states
+STATE_IDLE      = "idle"      # Handset down and nothing playing
+STATE_GREETING  = "greeting"  # Handset lifted, greeting playing and recording
+STATE_RECORDING = "recording" # Greeting finished, recording until the handset is put down
+STATE_STOPPING  = "stopping"  # Stopping the play and record threads
+STATE_REPLAY    = "replay"    # Playing the previous recording
+
+# Events put on a line's queue. The first three are GPIO edges; EVENT_PLAYED is posted by the player thread when playback ends.
+EDGE_HOOK_UP   = "hook_up"
+EDGE_HOOK_DOWN = "hook_down"
+EDGE_CHORD     = "chord"
+EVENT_PLAYED   = "played"
+edges = (EDGE_HOOK_UP, EDGE_HOOK_DOWN, EDGE_CHORD)
+
+# What each event does in each state, as the name of the Line method that handles it. The method returns the state to move to. Anything not
+# listed is rejected without touching the Phone.
+transitions = {
+    (STATE_IDLE,      EDGE_HOOK_UP):   "_start_call",
+    (STATE_GREETING,  EVENT_PLAYED):   "_greeting_played",
+    (STATE_GREETING,  EDGE_HOOK_DOWN): "_end_call",
+    (STATE_RECORDING, EDGE_HOOK_DOWN): "_end_call",
+    (STATE_REPLAY,    EDGE_HOOK_UP):   "_start_call",
+    (STATE_REPLAY,    EDGE_HOOK_DOWN): "_end_call",
+    (STATE_REPLAY,    EVENT_PLAYED):   "_replay_played",
+    (STATE_IDLE,      EDGE_CHORD):     "_replay",
+    (STATE_GREETING,  EDGE_CHORD):     "_replay",
+    (STATE_RECORDING, EDGE_CHORD):     "_replay",
+    (STATE_REPLAY,    EDGE_CHORD):     "_replay",
+}
+
+# One handset: its buttons, Phone, recording index, audio engine and storage manager, driven by a call state machine. The gpiozero callbacks
+# only timestamp the edge and put it on the line's queue, so they never block, and the line's own worker thread is the only one that touches
+# the Phone. It debounces the edges again by their timestamps (see _hook_edge()) and runs the rest through the transitions table in order.
+# So a line that is stuck stopping a wedged aplay never holds up the edges of another line (gpiozero can deliver every pin's callbacks from the
+# same thread), and the bounces that pile up meanwhile cost nothing once it is free again. If trace is given, every edge is written to it as it
+# is taken off the queue, for bench.py to replay.
+class Line():
+    def __init__(self, config, audio_backend="alsa", phone_options=None, storage_options=None, trace=None):
+        self.name = config["name"]
+        self.config = config
+        self._logger = logging.getLogger("Line %s" % self.name)
+        self._audio_backend = audio_backend
+        self._phone_options = phone_options or {}
+        self._storage_options = storage_options
+        self._trace = trace
+        self._events = queue.SimpleQueue()
+        self._thread = Thread(target=self._run, name="Line %s" % self.name, daemon=True)
+        self._playback = 0 # Increases with every play() so that the end of a playback that has since been replaced can be told apart
+        self._last_hook = None # The last hook edge acted on, as (edge, time)
+        self._bounce = None    # The newest hook edge held back as bounce since then, if the switch hasn't settled yet
+        self._bounces = 0
+        self._last_chord = float("-inf")
+        self.state = STATE_IDLE
+        self.recording_index = None
+        self.storage_manager = None
+        self.audio_engine = None
+        self.phone = None
+        self.buttons = ()
+
+    # Open everything the line needs and, unless arm is False (so that arming can be timed on its own), arm its buttons
+    def open(self, pin_factory=None, arm=True):
+        Path(self.config["out_dir"]).mkdir(parents=True, exist_ok=True)
+        self.recording_index = RecordingIndex(out_dir=self.config["out_dir"])
+        self.recording_index.open()
+        if self._storage_options is not None:
+            self.storage_manager = storage.StorageManager(out_dir=self.config["out_dir"], recording_index=self.recording_index, **self._storage_options)
+        self.audio_engine = create_audio_engine(logger=self._logger, backend=self._audio_backend, config=self.config)
+        self.phone = Phone(audio_engine=self.audio_engine, recording_index=self.recording_index, storage_manager=self.storage_manager,
+                           playback_device=self.config["playback_device"], capture_device=self.config["capture_device"], name=self.name,
+                           **self._phone_options)
+        self._thread.start()
+        if arm: self.arm(pin_factory=pin_factory)
+
+    # Create the handset and key chord buttons and register the callback functions to be called upon button activations. A pin_factory can
+    # be given to use something other than the default gpiozero pin factory, such as the MockFactory used by bench.py.
+    def arm(self, pin_factory=None):
+        from gpiozero import Button # Imported here so that phony.py can start importing it in the background at startup
+        hook_button = Button(pin=self.config["hook_pin"], pull_up=True, bounce_time=self.config["hook_debounce_s"], pin_factory=pin_factory)
+        hook_button.when_activated = lambda: self.post(EDGE_HOOK_UP)
+        hook_button.when_deactivated = lambda: self.post(EDGE_HOOK_DOWN)
+        chord_button = Button(pin=self.config["chord_pin"], pull_up=True, bounce_time=self.config["chord_debounce_s"], pin_factory=pin_factory)
+        chord_button.when_activated = lambda: self.post(EDGE_CHORD)
+        self.buttons = (hook_button, chord_button)
+
+    def prewarm(self):
+        self.recording_index.prewarm(ext="." + self.phone.record_format)
+        self.phone.prewarm(greeting=self.config["greeting"])
+
+    # Start the storage manager, if there is one. Done once phony is ready so that its first pass doesn't compete with startup.
+    def start_storage(self):
+        if self.storage_manager: self.storage_manager.start()
+
+    # Queue an event for the worker thread. Called on the gpiozero callback threads, so it does nothing else. edge_time defaults to now.
+    def post(self, event, edge_time=None, data=None):
+        self._events.put((event, monotonic() if edge_time is None else edge_time, data))
+
+    def _run(self):
+        while True:
+            try:
+                event, edge_time, data = self._events.get(timeout=self._settle_timeout())
+            except queue.Empty:
+                self._settle()
+                continue
+            if event is None: return
+            if self._trace and event in edges: self._trace.write("%.6f %s %s\n" % (edge_time, self.name, event))
+            if event in (EDGE_HOOK_UP, EDGE_HOOK_DOWN):
+                self._hook_edge(event, edge_time)
+            elif event == EDGE_CHORD and edge_time - self._last_chord < self.config["chord_debounce_s"]:
+                metrics.inc("phony_edges_coalesced_total")
+            else:
+                if event == EDGE_CHORD: self._last_chord = edge_time
+                self._handle(event, edge_time, data)
+
+    # Debounce the hook switch by edge time rather than arrival time, so that bounces that queued up while the line was busy are still
+    # recognised. The first edge of a burst is acted on straight away; the rest, up to hook_debounce_s after the one before, are held back as
+    # bounce. Once the switch has been still for hook_debounce_s, _settle() acts on where it came to rest if that differs.
+    def _hook_edge(self, event, edge_time):
+        newest = self._bounce or self._last_hook
+        if newest and edge_time - newest[1] < self.config["hook_debounce_s"]:
+            self._bounce = (event, edge_time)
+            self._bounces += 1
+            return
+        self._settle()
+        self._last_hook = (event, edge_time)
+        self._handle(event, edge_time, None)
+
+    def _settle_timeout(self):
+        return max(0, self._bounce[1] + self.config["hook_debounce_s"] - monotonic()) if self._bounce else None
+
+    def _settle(self):
+        bounce, self._bounce = self._bounce, None
+        if bounce is None: return
+        moved = bounce[0] != self._last_hook[0]
+        metrics.inc("phony_edges_coalesced_total", self._bounces - moved)
+        self._bounces = 0
+        if moved:
+            self._last_hook = bounce
+            self._handle(bounce[0], bounce[1], None)
+
+    def _handle(self, event, edge_time, data):
+        if event == EVENT_PLAYED and data != self._playback: return # A playback that was stopped
+        name = transitions.get((self.state, event))
+        if name is None:
+            self._logger.debug("Ignoring %s while %s" % (event, self.state))
+            metrics.inc("phony_edges_rejected_total", event=event)
+            return
+        old_state = self.state
+        try:
+            self.state = getattr(self, name)(edge_time)
+        except Exception as err:
+            self._logger.error("%s failed: %s: %s" % (name, type(err).__name__, err))
+            self.state = STATE_STOPPING
+            self.phone.stop()
+            self.state = STATE_IDLE
+        if self.state != old_state: self._logger.debug("%s: %s -> %s" % (event, old_state, self.state))
+
+    def _play(self, audio_file, latency_metric, edge_time):
+        self._playback += 1
+        self.phone.play(audio_file=audio_file, on_start=latency_observer(latency_metric, edge_time),
+                        on_end=lambda playback=self._playback: self.post(EVENT_PLAYED, data=playback))
+
+    def _stop_phone(self):
+        self.state = STATE_STOPPING
+        self._playback += 1 # The end of the playback being stopped is expected, not an event
+        self.phone.stop()
+
+    # The handset was lifted off the receiver. Simultaneously start playing the greeting message from the handset speaker and recording from
+    # the handset microphone, cutting short the replay of the previous recording if there is one.
+    def _start_call(self, edge_time):
+        if self.state == STATE_REPLAY: self._stop_phone()
+        metrics.inc("phony_calls_total")
+        seq, new_file_name = self.recording_index.allocate(ext="." + self.phone.record_format)
+        self._logger.debug("Using new filename %s" % (new_file_name))
+        self._play(self.config["greeting"], "phony_greeting_start_seconds", edge_time)
+        self.phone.record(audio_file=new_file_name, seq=seq, on_start=latency_observer("phony_recording_start_seconds", edge_time))
+        return STATE_GREETING
+
+    def _greeting_played(self, edge_time):
+        return STATE_RECORDING
+
+    # The handset was placed down onto the receiver. Halt any ongoing playback and recording.
+    def _end_call(self, edge_time):
+        self._stop_phone()
+        metrics.observe("phony_hangup_seconds", monotonic() - edge_time)
+        return STATE_IDLE
+
+    # The special key chord combination was pressed on the phone receiver. Stop any ongoing call and then play the second-last recording
+    # (since the first-last will be the one that was just terminated).
+    def _replay(self, edge_time):
+        metrics.inc("phony_replays_total")
+        self._stop_phone()
+        second_last_recording = self.phone.getSecondLastRecording()
+        if second_last_recording is None:
+            self._logger.warning("There is no previous recording to play")
+            return STATE_IDLE
+        self._play(second_last_recording, "phony_replay_start_seconds", edge_time)
+        return STATE_REPLAY
+
+    def _replay_played(self, edge_time):
+        return STATE_IDLE
+
+    def close(self):
+        for button in self.buttons: button.close()
+        if self._thread.is_alive():
+            self.post(None)
+            self._thread.join()
+        if self.phone:
+            self.phone.stop()
+            self.phone.close()
+        if self.storage_manager: self.storage_manager.stop()
+        if self.audio_engine: self.audio_engine.close()
+        if self.recording_index: self.recording_index.close()
+
+# Runs a Line for each configured handset. A line that fails to open is logged and left out rather than taking the others down with it.
+class LineManager():
+    def __init__(self, configs, **line_options):
+        self._logger = logging.getLogger("Line Manager")
+        self.lines = [Line(config, **line_options) for config in configs]
+
+    def open(self, pin_factory=None, arm=True):
+        self._each("open", pin_factory=pin_factory, arm=arm)
+        self._logger.info("%d line(s) %s: %s" % (len(self.lines), "ready" if arm else "open", ", ".join(line.name for line in self.lines)))
+
+    # Arm the buttons of lines that were opened with arm=False
+    def arm(self, pin_factory=None):
+        self._each("arm", pin_factory=pin_factory)
+        self._logger.info("%d line(s) ready: %s" % (len(self.lines), ", ".join(line.name for line in self.lines)))
+
+    # Call the given method of every line, closing and leaving out any line it fails on
+    def _each(self, method, **kwargs):
+        kept = []
+        for line in self.lines:
+            try:
+                getattr(line, method)(**kwargs)
+            except Exception as err:
+                self._logger.error("Unable to %s line %s: %s: %s" % (method, line.name, type(err).__name__, err))
+                line.close()
+                continue
+            kept.append(line)
+        if not kept: raise Exception("None of the %d lines could be %s" % (len(self.lines), "opened" if method == "open" else "armed"))
+        self.lines = kept
+
+    def prewarm(self):
+        for line in self.lines: line.prewarm()
+
+    def start_storage(self):
+        for line in self.lines: line.start_storage()
+
+    # Return True if any line is in a call (or replaying or post-processing a recording)
+    def busy(self):
+        return any(line.phone.busy() for line in self.lines)
+
+    def post_processing(self):
+        return any(line.phone.post_processing() for line in self.lines)
+
+    def close(self):
+        for line in self.lines: line.close()
@@ -0,0 +1,177 @@
+import logging, os, math
+from threading import Thread, Lock, Event
+
+# Buckets (in seconds) used for all of the latency histograms
+latency_buckets = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+# Every metric that phony reports, as name: (type, help text)
+definitions = {
+    "phony_calls_total":                     ("counter",   "Number of times the handset was lifted"),
+    "phony_call_failures_total":             ("counter",   "Number of recordings that ended with an error"),
+    "phony_replays_total":                   ("counter",   "Number of times the previous recording was replayed"),
+    "phony_subprocess_exits_total":          ("counter",   "Number of aplay/arecord processes that exited, by return code"),
+    "phony_bytes_recorded_total":            ("counter",   "Bytes of audio captured into recordings"),
+    "phony_recorder_overruns_total":         ("counter",   "Number of times the recorder ring buffer overflowed and audio was dropped"),
+    "phony_empty_calls_total":               ("counter",   "Number of recordings that silence detection found no speech in"),
+    "phony_silence_trimmed_seconds_total":   ("counter",   "Seconds of leading and trailing silence trimmed from recordings"),
+    "phony_recordings_evicted_total":        ("counter",   "Number of recordings deleted to stay within the storage quota"),
+    "phony_calls_refused_total":             ("counter",   "Number of calls that weren't recorded because there wasn't enough free space"),
+    "phony_edges_coalesced_total":           ("counter",   "Number of GPIO edges dropped as switch bounce"),
+    "phony_edges_rejected_total":            ("counter",   "Number of events ignored because they aren't valid in the current call state, by event"),
+    "phony_served_bytes_total":              ("counter",   "Bytes of recordings sent by the recording server"),
+    "phony_greeting_start_seconds":          ("histogram", "Time from the handset being lifted to the greeting starting"),
+    "phony_recording_start_seconds":         ("histogram", "Time from the handset being lifted to the first captured audio"),
+    "phony_replay_start_seconds":            ("histogram", "Time from the key chord being pressed to the previous recording starting"),
+    "phony_hangup_seconds":                  ("histogram", "Time from the handset being put down to the recording file being closed"),
+    "phony_thread_join_seconds":             ("histogram", "Time taken to join the play and record threads when stopping"),
+    "phony_log_messages_dropped_total":      ("counter",   "Number of log messages dropped because the log queue was full"),
+    "phony_storage_free_bytes":              ("gauge",     "Free space on the filesystem holding the output directory"),
+    "phony_storage_used_bytes":              ("gauge",     "Space used by the output directory"),
+}
+
+# The registry in use, or None if metrics are disabled. Every recording function checks this first, so instrumentation costs one global
+# lookup and a comparison when metrics are off.
+registry = None
+
+# Holds the current value of every metric sample and renders them in the Prometheus text exposition format
+class Registry():
+    def __init__(self):
+        self._lock = Lock()
+        self._values = {}     # (name, labels) -> value, for counters and gauges
+        self._histograms = {} # (name, labels) -> [bucket counts, sum, count]
+        self._collectors = [] # Functions called just before rendering, for values that are sampled rather than pushed
+
+    def inc(self, name, amount, labels):
+        key = (name, labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def set(self, name, value, labels):
+        with self._lock:
+            self._values[(name, labels)] = value
+
+    def observe(self, name, value, labels):
+        key = (name, labels)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None: histogram = self._histograms[key] = [[0] * len(latency_buckets), 0.0, 0]
+            for i, bound in enumerate(latency_buckets):
+                if value <= bound: histogram[0][i] += 1
+            histogram[1] += value
+            histogram[2] += 1
+
+    def add_collector(self, collector):
+        self._collectors.append(collector)
+
+    def render(self):
+        for collector in self._collectors: collector()
+        with self._lock:
+            values = dict(self._values)
+            histograms = {key: (list(h[0]), h[1], h[2]) for key, h in self._histograms.items()}
+
+        lines = []
+        for name, (metric_type, help_text) in definitions.items():
+            samples = sorted((labels, value) for (n, labels), value in values.items() if n == name)
+            series = sorted((labels, h) for (n, labels), h in histograms.items() if n == name)
+            if not samples and not series: continue
+            lines.append("# HELP %s %s" % (name, help_text))
+            lines.append("# TYPE %s %s" % (name, metric_type))
+            for labels, value in samples:
+                lines.append("%s%s %s" % (name, format_labels(labels), format_value(value)))
+            for labels, (buckets, total, count) in series:
+                for bound, bucket_count in zip(latency_buckets, buckets):
+                    lines.append("%s_bucket%s %d" % (name, format_labels(labels + (("le", format_value(bound)), )), bucket_count))
+                lines.append("%s_bucket%s %d" % (name, format_labels(labels + (("le", "+Inf"), )), count))
+                lines.append("%s_sum%s %s" % (name, format_labels(labels), format_value(total)))
+                lines.append("%s_count%s %d" % (name, format_labels(labels), count))
+        return "\n".join(lines) + "\n"
+
+def format_labels(labels):
+    if not labels: return ""
+    return "{" + ",".join('%s="%s"' % (k, str(v).replace("\\", "\\\\").replace('"', '\\"')) for k, v in labels) + "}"
+
+def format_value(value):
+    if isinstance(value, float) and math.isinf(value): return "+Inf" if value > 0 else "-Inf"
+    return repr(value) if isinstance(value, float) else str(value)
+
+# Functions used by the rest of phony to record metrics. Labels are given as keyword arguments.
+def inc(name, amount=1, **labels):
+    if registry is None: return
+    registry.inc(name, amount, tuple(sorted(labels.items())))
+
+def set_gauge(name, value, **labels):
+    if registry is None: return
+    registry.set(name, value, tuple(sorted(labels.items())))
+
+# Set a counter whose running total is kept elsewhere, from a collector
+def set_total(name, value, **labels):
+    if registry is None: return
+    registry.set(name, value, tuple(sorted(labels.items())))
+
+def observe(name, value, **labels):
+    if registry is None: return
+    registry.observe(name, value, tuple(sorted(labels.items())))
+
+# Turn metrics collection on. Until this is called (or if it never is), all of the functions above do nothing.
+def enable():
+    global registry
+    if registry is None: registry = Registry()
+    return registry
+
+# Periodically writes the metrics to a Prometheus textfile (e.g. for node_exporter's textfile collector). The file is written to a temporary
+# name and renamed into place so that readers never see a partial file.
+class TextfileExporter():
+    def __init__(self, path, interval_s=15):
+        self._logger = logging.getLogger("Metrics")
+        self._path = str(path)
+        self._interval_s = interval_s
+        self._stop = Event()
+        self._thread = Thread(target=self._run, name="Metrics Writer", daemon=True)
+
+    def start(self):
+        self._logger.info("Writing metrics to %s every %ds" % (self._path, self._interval_s))
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        self.write()
+
+    def _run(self):
+        while not self._stop.wait(self._interval_s):
+            self.write()
+
+    def write(self):
+        if registry is None: return
+        tmp_path = self._path + ".tmp"
+        try:
+            with open(tmp_path, "w") as f:
+                f.write(registry.render())
+            os.replace(tmp_path, self._path)
+        except OSError as err:
+            self._logger.error("Unable to write metrics to %s: %s" % (self._path, err))
+
+# Serve the metrics at http://<address>:<port>/metrics from a background thread. Only binds to localhost by default.
+def serve_http(port, address="127.0.0.1"):
+    from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler # Imported here since it takes a while and is rarely needed
+
+    class MetricsRequestHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path not in ("/", "/metrics"):
+                self.send_error(404)
+                return
+            body = (registry.render() if registry else "").encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            logging.getLogger("Metrics").debug("HTTP: " + format % args)
+
+    server = ThreadingHTTPServer((address, port), MetricsRequestHandler)
+    server.daemon_threads = True
+    Thread(target=server.serve_forever, name="Metrics Server", daemon=True).start()
+    logging.getLogger("Metrics").info("Serving metrics at http://%s:%d/metrics" % (address, port))
+    return server
@@ -1,21 +1,70 @@
-import logging, struct, fcntl, termios, shutil, sys, pty, os, select, errno
-from subprocess import Popen
-from time import sleep
-from select import select
+import logging, struct, fcntl, termios, shutil, shlex, sys, pty, os, selectors, errno, tempfile, audio, recordings, encoder, metrics, silence, storage
+from subprocess import Popen, TimeoutExpired
+from time import monotonic
 from signal import SIGTERM, SIGKILL
 from itertools import chain
+from pathlib import Path
 from threading import Thread, Event, current_thread
+from concurrent.futures import ThreadPoolExecutor
+from recorder import BufferedRecorder
+
+# Passes a child process' output to the 'verbatim' logger one line at a time. This way it goes through the logging queue (and into the log
+# file) rather than the runner thread writing and flushing the console itself.
+class OutputLogger():
+    def __init__(self, level=logging.INFO):
+        self._logger = logging.getLogger("verbatim")
+        self._level = level
+        self._partial = b""
+
+    def write(self, data):
+        lines = (self._partial + data).split(b"\n")
+        self._partial = lines.pop()
+        for line in lines: self._emit(line)
+
+    # Emit whatever is left over after the last newline
+    def flush(self):
+        if self._partial: self._emit(self._partial)
+        self._partial = b""
+
+    def _emit(self, line):
+        self._logger.log(self._level, line.rstrip(b"\r").decode(errors="replace"))
 
 class Phone():
-    def __init__(self):
-        self._logger = logging.getLogger("Phone Manager")
+    # If an audio_engine is given, playback and recording are streamed through it instead of spawning aplay/arecord for each call. If a
+    # recording_index is given, finished recordings are recorded in it and it is used to look up previous recordings. record_format is 'wav' or
+    # one of the compressed formats in encoder.formats, which are encoded as they are captured. If trim_silence is set, recordings are run
+    # through a silence.SilenceDetector as they are captured and are trimmed once they finish; empty_calls ('flag' or 'discard') says what
+    # happens to recordings without any speech. If a storage_manager is given, a recording is only started if it says there is room for it.
+    # playback_device and capture_device are the ALSA devices aplay and arecord use. If a name is given it is added to the logger and thread
+    # names so that the Phones of different lines can be told apart.
+    def __init__(self, audio_engine=None, recording_index=None, record_format="wav", trim_silence=False, empty_calls="flag", storage_manager=None,
+                 playback_device="plughw:1,0", capture_device="plughw:1,0", name=None):
+        self._name_suffix = " %s" % name if name else ""
+        self._logger = logging.getLogger("Phone Manager" + self._name_suffix)
+        self._engine = audio_engine
+        self._index = recording_index
+        self._storage = storage_manager
+        self.record_format = record_format
+        self._trim_silence = trim_silence
+        self._empty_calls = empty_calls
+        # Trimming rewrites the file, so it is done on a separate thread after the recorder has finished rather than holding up stop()
+        self._post_processor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="Silence") if trim_silence else None
+        self._last_post = None # The most recently submitted post-processing job. There is one worker, so once it is done they all are.
         self._tjoin_timeout = 5
+        self._term_timeout = 0.5
         self._play_thread = None
         self._rcrd_thread = None
-        self._play_cmd_pfx = "aplay --device=plughw:1,0 "
-        self._rcrd_cmd_pfx = "arecord --device=plughw:1,0 --format=S16_LE --rate=44100 "
+        self._play_cmd_pfx = "aplay --device=%s " % playback_device
+        self._rcrd_cmd = "arecord --device=%s --format=S16_LE --rate=44100 --file-type=raw --quiet" % capture_device
         self._stop = Event()
         self._rcrd_list = []
+        self._replay_dir = None # Where archived recordings are extracted to for replay, created the first time one is needed
+        self.last_record_stats = None
+
+        # The stop event is paired with a 'self-pipe' so that the runner threads can block in select() on their PTYs and still be woken
+        # immediately when stop() is called. A single byte is written by stop() and left in the pipe until both runner threads have exited.
+        self._wake_r, self._wake_w = os.pipe()
+        for fd in (self._wake_r, self._wake_w): os.set_blocking(fd, False)
 
     # Do some magic fnctl stuff to set the virtual terminal window size of a PTY in order to match the current terminal size.
     def _set_pty_terminal_size(self, fd):
@@ -25,7 +74,9 @@ class Phone():
 
     # This function is intended to run in a separate thread. It run a subprocess given by the passed in command. The stdout and stderr streams are
     # captured as they are emitted and logged to the console. The passed in stop event can be used to terminate the command before it completes.
-    def _cmd_runner(self, cmd, stop):
+    # If a sink callable is given, the child's stdout is connected to a pipe instead and everything it emits is passed to the sink; this is how
+    # arecord streams raw audio into the recorder. If on_start is given it is called once the process has been spawned.
+    def _cmd_runner(self, cmd, stop, sink=None, on_start=None):
         thread_name = current_thread().name
         logger = logging.getLogger(thread_name)
         logger.debug("%s thread started" % thread_name)
@@ -38,6 +89,11 @@ class Phone():
             # trigger is being run from.
             masters, slaves = zip(pty.openpty(), pty.openpty())
             for fd in chain(masters, slaves): self._set_pty_terminal_size(fd)
+            if sink:
+                # Binary data mustn't go through a PTY's line discipline, so stdout gets a plain pipe. The PTY opened for it is not needed.
+                for fd in (masters[0], slaves[0]): os.close(fd)
+                stdout_r, stdout_w = os.pipe()
+                masters, slaves = (stdout_r, masters[1]), (stdout_w, slaves[1])
 
             # Start the child process, using the select module to allow for non-blocking reads of the stdout and stderr streams. Note that the order
             # of messages between these streams cannot be guaranteed but in practice this doesn't seem to be an issue.
@@ -45,44 +101,48 @@ class Phone():
             with Popen(args=cmd, stdin=sys.stdin, stdout=slaves[0], stderr=slaves[1], shell=True, preexec_fn=os.setsid) as proc:
                 # Close the slave file descriptors here as we won't reference them past this point.
                 for fd in slaves: os.close(fd)
+                if on_start: on_start()
 
-                # Enter a select() loop to receive stdout and stderr stream data in a non-blocking manner
+                # Block on the stdout and stderr PTYs plus the stop wakeup pipe. The thread sleeps in the kernel until the child emits output,
+                # the child exits (the PTY reads then return EIO/EOF) or stop() writes to the wakeup pipe.
+                output_loggers = [OutputLogger(), OutputLogger()]
                 readable = {
-                    masters[0]: sys.stdout.buffer,
-                    masters[1]: sys.stderr.buffer,
+                    masters[0]: (sink, 64 * 1024) if sink else (output_loggers[0].write, 4096),
+                    masters[1]: (output_loggers[1].write, 4096),
                 }
-                while readable:
-                    if stop.isSet():
-                        logger.info("Received stop event")
-                        break
-                    for fd in select(readable, [], [], 0)[0]:
-                        try:
-                            data = os.read(fd, 1024)
-                        except OSError as e:
-                            if (e.errno != errno.EIO): # EIO is an I/O Error
-                                raise
-                            del readable[fd]
-                        else:
+                with selectors.DefaultSelector() as selector:
+                    for fd in readable: selector.register(fd, selectors.EVENT_READ)
+                    selector.register(self._wake_r, selectors.EVENT_READ)
+                    while readable and not stop.is_set():
+                        for key, _ in selector.select():
+                            fd = key.fd
+                            if fd == self._wake_r: continue
+                            write, read_size = readable[fd]
+                            try:
+                                data = os.read(fd, read_size)
+                            except OSError as e:
+                                if (e.errno != errno.EIO): # EIO is an I/O Error
+                                    raise
+                                data = b""
                             # If an empty bytes object is returned it means the EOF has been reached which indicates the process has terminated.
                             if not data:
+                                selector.unregister(fd)
                                 del readable[fd]
                             else:
-                                # Write the data to the corresponding sys stream so that it looks transparent to the user
-                                readable[fd].write(data)
-                                readable[fd].flush()
-
-                if stop.isSet() and proc.poll() == None:
-                    logger.debug("Sending SIGTERM to subprocess")
-                    os.killpg(os.getpgid(proc.pid), SIGTERM)
-                    sleep(0.5)
+                                # Pass the data on to the sink, or log it verbatim so that it looks transparent to the user
+                                write(data)
+                for output_logger in output_loggers: output_logger.flush()
+
+                if stop.is_set():
+                    logger.info("Received stop event")
                     if proc.poll() == None:
-                        logger.warning("Process is still alive after sending SIGTERM. Sending SIGKILL")
-                        os.killpg(os.getpgid(proc.pid, SIGKILL))
+                        self._terminate(proc, logger)
 
             # If we've reached here, the child process has terminated
             for fd in masters: os.close(fd)
             ret_code = proc.returncode
             logger.info("Process finished with return code %d" % (ret_code))
+            metrics.inc("phony_subprocess_exits_total", code=ret_code)
 
         except Exception as err:
             ret_code = -2
@@ -92,43 +152,261 @@ class Phone():
         logger.debug("%s thread finished" % thread_name)
         return ret_code
 
+    # Terminate the process group of a child started by _cmd_runner(). SIGTERM is sent first and the child is reaped as soon as it exits;
+    # SIGKILL is only sent if it is still alive after _term_timeout seconds.
+    def _terminate(self, proc, logger):
+        logger.debug("Sending SIGTERM to subprocess")
+        try:
+            os.killpg(proc.pid, SIGTERM) # The child is a session leader (setsid) so its pid is also its process group id
+            proc.wait(timeout=self._term_timeout)
+        except ProcessLookupError:
+            pass
+        except TimeoutExpired:
+            logger.warning("Process is still alive after sending SIGTERM. Sending SIGKILL")
+            try:
+                os.killpg(proc.pid, SIGKILL)
+            except ProcessLookupError:
+                pass
+            proc.wait()
+
+    # This function is the audio engine counterpart of _cmd_runner(). It streams the given file to the speaker ('play') or the microphone into
+    # the given sink ('record') until it completes or the stop event is set, and returns a _cmd_runner style return code. on_start is passed on
+    # to AudioEngine.play(). A file the engine can't play is handed to aplay, and a capture device that has failed to arecord.
+    def _engine_runner(self, mode, audio_file, stop, sink=None, on_start=None):
+        thread_name = current_thread().name
+        logger = logging.getLogger(thread_name)
+        logger.debug("%s thread started" % thread_name)
+
+        try:
+            if mode == "play" and encoder.is_compressed(audio_file):
+                logger.info("Decoding and streaming %s to the speaker" % audio_file)
+                with encoder.open_decoder(audio_file) as proc:
+                    ret_code = self._engine.play(proc.stdout, stop, on_start=on_start)
+                    proc.kill()
+            elif mode == "play":
+                logger.info("Streaming %s to the speaker" % audio_file)
+                ret_code = self._engine.play(audio_file, stop, on_start=on_start)
+            else:
+                logger.info("Streaming the microphone to %s" % audio_file)
+                ret_code = self._engine.capture(sink, stop)
+            logger.info("Streaming finished with return code %d" % (ret_code))
+
+        except audio.AudioFormatError as err:
+            logger.warning("%s. Falling back to aplay" % (err))
+            ret_code = self._cmd_runner(self._play_cmd_pfx + str(audio_file), stop, on_start=on_start)
+
+        except audio.AudioDeviceError as err:
+            if stop.is_set():
+                logger.error("%s. The recording is incomplete" % (err))
+                ret_code = -2
+            else:
+                logger.warning("%s. Falling back to arecord" % (err))
+                ret_code = self._cmd_runner(self._rcrd_cmd, stop, sink=sink)
+
+        except Exception as err:
+            ret_code = -2
+            logger.error("A %s exception was raised while trying to %s %s" % (type(err).__name__, mode, audio_file))
+            logger.error("Exception: %s" % (err))
+
+        logger.debug("%s thread finished" % thread_name)
+        return ret_code
+
     # Play an audio file out of the handset speaker. Only one instance of this function can run at a time to avoid multiple sounds from attempting
-    # to be played simultaneously.
-    def play(self, audio_file):
+    # to be played simultaneously. If on_start is given it is called from the player thread as soon as playback has started, and if on_end is
+    # given it is called from the player thread once playback has finished or been stopped.
+    def play(self, audio_file, on_start=None, on_end=None):
         if not self._play_thread or self._play_thread.is_alive() == False:
-            cmd = self._play_cmd_pfx + str(audio_file)
-            self._play_thread = Thread(target=self._cmd_runner, args=(cmd, self._stop, ), name="Player", daemon=True)
+            if self._engine:
+                target, args = self._engine_runner, ("play", audio_file, self._stop, None, on_start, )
+            elif encoder.is_compressed(audio_file):
+                cmd = shlex.join(encoder.command(Path(audio_file).suffix[1:], "decode", src=audio_file)) + " | " + self._play_cmd_pfx
+                target, args = self._cmd_runner, (cmd, self._stop, None, on_start, )
+            else:
+                target, args = self._cmd_runner, (self._play_cmd_pfx + str(audio_file), self._stop, None, on_start, )
+            if on_end: target, args = self._notify_end, (target, args, on_end, )
+            self._play_thread = Thread(target=target, args=args, name="Player" + self._name_suffix, daemon=True)
             self._play_thread.start()
         else:
             self._logger.warning("Attempted to call play() while play is in progress")
 
+    # This function is intended to run in the recorder thread. Captured audio is fed from the audio engine or from arecord's stdout into a
+    # BufferedRecorder, which writes it out to the WAV file (or the encoder) from its own thread. Once the capture ends the file is finalized
+    # and, if a recording index is in use, the recording is marked as finished. A recording that was ended by stop() is complete; one whose
+    # capture ended on its own with an error is failed. If on_start is given it is called when the first captured audio arrives.
+    def _record_runner(self, audio_file, seq, stop, on_start=None):
+        self.last_record_stats = None
+        analyzer = None
+        try:
+            output = encoder.EncoderPipe(audio_file, self.record_format) if self.record_format != "wav" else None
+            analyzer = self._create_detector() if self._trim_silence else None
+            writer = BufferedRecorder(audio_file, output=output, analyzer=analyzer)
+            sink = self._notify_first(writer.write, on_start) if on_start else writer.write
+        except Exception as err:
+            self._logger.error("A %s exception was raised while trying to create %s" % (type(err).__name__, audio_file))
+            self._logger.error("Exception: %s" % (err))
+            ret_code = -2
+        else:
+            try:
+                if self._engine:
+                    ret_code = self._engine_runner("record", audio_file, stop, sink=sink)
+                else:
+                    ret_code = self._cmd_runner(self._rcrd_cmd, stop, sink=sink)
+            finally:
+                try:
+                    self.last_record_stats = writer.close()
+                except Exception as err:
+                    self._logger.error("Unable to finalize %s: %s" % (audio_file, err))
+                    self.last_record_stats = writer.stats()
+                    ret_code = -2
+        status = recordings.STATUS_COMPLETE if ret_code == 0 or (stop.is_set() and ret_code != -2) else recordings.STATUS_FAILED
+        if status == recordings.STATUS_FAILED: metrics.inc("phony_call_failures_total")
+        if self.last_record_stats:
+            metrics.inc("phony_bytes_recorded_total", self.last_record_stats["bytes_written"])
+            metrics.inc("phony_recorder_overruns_total", self.last_record_stats["overruns"])
+        post_process = analyzer and status == recordings.STATUS_COMPLETE and not self.last_record_stats["analyzer_failed"]
+        if self._index and seq is not None:
+            # A recording that is about to be trimmed isn't complete until _post_process() says so, so that the batch tools leave it alone
+            duration = self.last_record_stats["bytes_written"] / (audio.sample_rate * audio.frame_bytes) if self.last_record_stats else None
+            self._index.finish(seq, status=recordings.STATUS_PROCESSING if post_process else status, duration=duration)
+        if post_process:
+            self._last_post = self._post_processor.submit(self._post_process, audio_file, seq, analyzer.result())
+        return ret_code
+
+    # Do the one-off work of the first call ahead of time: import NumPy if silence detection is on, check the free space and, if the greeting
+    # will be played by aplay, read it into the page cache
+    def prewarm(self, greeting=None):
+        if self._trim_silence: self._create_detector()
+        if self._storage: self._storage.has_room()
+        if greeting and not self._engine:
+            with open(greeting, "rb") as f:
+                while f.read(1024 * 1024): pass
+
+    # Create a silence detector for a new recording. Returns None (and turns silence detection off) if NumPy isn't installed.
+    def _create_detector(self):
+        try:
+            return silence.SilenceDetector()
+        except ImportError as err:
+            self._logger.error("Silence detection is unavailable (%s). Recordings won't be trimmed" % err)
+            self._trim_silence = False
+            return None
+
+    # Trim a finished recording and flag or discard it if it had no speech in it, then bring the index up to date, which moves the recording
+    # out of the processing status whatever happens. Runs on the post-processing thread.
+    def _post_process(self, audio_file, seq, result):
+        try:
+            meta = silence.process_recording(audio_file, result, empty_action=self._empty_calls)
+        except Exception as err:
+            self._logger.error("Unable to post-process %s: %s: %s" % (audio_file, type(err).__name__, err))
+            if self._index and seq is not None: self._index.update(seq, status=recordings.STATUS_COMPLETE)
+            return
+        kept_s = meta["kept_end_s"] - meta["kept_start_s"]
+        self._logger.info("%s: %s, %.1f s of speech, kept %.1f of %.1f s" % (Path(audio_file).name, meta["action"], meta["speech_s"], kept_s,
+                                                                             meta["duration_s"]))
+        if not meta["has_speech"]: metrics.inc("phony_empty_calls_total")
+        if meta["trimmed"]: metrics.inc("phony_silence_trimmed_seconds_total", meta["duration_s"] - kept_s)
+        if self._index and seq is not None:
+            self._index.update(seq, status=silence.index_status(meta) or recordings.STATUS_COMPLETE, duration=kept_s if meta["trimmed"] else None)
+
+    # Run a runner and then call on_end, whatever happened
+    def _notify_end(self, runner, args, on_end):
+        try:
+            return runner(*args)
+        finally:
+            on_end()
+
+    # Wrap a sink so that callback is called just before the first data is passed on to it
+    def _notify_first(self, sink, callback):
+        pending = [callback]
+        def notifying_sink(data):
+            if pending:
+                pending.pop()()
+            sink(data)
+        return notifying_sink
+
     # Record an audio file from the handset microphone. Only one instance of this function can run at a time to avoid attempting to make multiple
-    # recordings simultaneously.
-    def record(self, audio_file):
-        if not self._rcrd_thread or self._rcrd_thread.is_alive() == False:
-            cmd = self._rcrd_cmd_pfx + audio_file
+    # recordings simultaneously. seq is the recording's sequence number in the recording index, if one is in use. If on_start is given it is
+    # called from the recorder thread when the first captured audio arrives.
+    def record(self, audio_file, seq=None, on_start=None):
+        if self._storage and not self._storage.has_room():
+            self._logger.error("Not enough free space to record %s" % audio_file)
+            metrics.inc("phony_calls_refused_total")
+            self._rcrd_list.append(audio_file) # Still the current call as far as getSecondLastRecording() is concerned
+            if self._index and seq is not None: self._index.finish(seq, status=recordings.STATUS_SKIPPED)
+        elif not self._rcrd_thread or self._rcrd_thread.is_alive() == False:
             self._rcrd_list.append(audio_file)
-            self._rcrd_thread = Thread(target=self._cmd_runner, args=(cmd, self._stop, ), name="Recorder", daemon=True)
+            self._rcrd_thread = Thread(target=self._record_runner, args=(audio_file, seq, self._stop, on_start, ), name="Recorder" + self._name_suffix, daemon=True)
             self._rcrd_thread.start()
         else:
             self._logger.warning("Attempted to call record() while recording is in progress")
+            if self._index and seq is not None: self._index.finish(seq, status=recordings.STATUS_SKIPPED) # Otherwise it stays 'recording' forever
+
+    # Return True while audio is being played or recorded, or a recording is still being post-processed
+    def busy(self):
+        return any(thread and thread.is_alive() for thread in (self._play_thread, self._rcrd_thread)) or self.post_processing()
+
+    # Return True while a recording is still being post-processed (i.e. trimmed) or the recorder is finishing one that will be
+    def post_processing(self):
+        return (self._last_post is not None and not self._last_post.done()) or \
+               (self._trim_silence and self._rcrd_thread is not None and self._rcrd_thread.is_alive() and self._stop.is_set())
 
     # Halt any ongoing playback or recording. This is used to halt the play and record threads when the handset is place down onto the receiver.
+    # Both runner threads are woken at once through the wakeup pipe and terminate their children in parallel, so the joins share a single
+    # deadline rather than each waiting out its own timeout. Returns False if a thread is still running at the deadline. It is left with its
+    # stop event set, so it still exits once whatever it is stuck on returns, and later calls get a fresh event.
     def stop(self):
         self._logger.info("Stopping play and record threads")
-        self._stop.set()
-        self._play_thread.join(timeout=self._tjoin_timeout)
-        if self._play_thread.is_alive():
-            raise Exception("Play thread didn't terminate after %ds" % self._tjoin_timeout)
-        self._rcrd_thread.join(timeout=self._tjoin_timeout)
-        if self._rcrd_thread.is_alive():
-            raise Exception("Record thread didn't terminate after %ds" % self._tjoin_timeout)
-        self._stop.clear()
+        stop = self._stop
+        stop.set()
+        try:
+            os.write(self._wake_w, b"\0")
+        except BlockingIOError:
+            pass # The pipe is already full of wakeup bytes, which is just as good
+        deadline = monotonic() + self._tjoin_timeout
+        stuck = []
+        for name, thread in (("Play", self._play_thread), ("Record", self._rcrd_thread)):
+            if thread is None: continue
+            join_start = monotonic()
+            thread.join(timeout=max(0, deadline - monotonic()))
+            metrics.observe("phony_thread_join_seconds", monotonic() - join_start, thread=name)
+            if thread.is_alive(): stuck.append(name)
+        self._drain_wakeup()
+        if stuck:
+            self._logger.error("%s thread didn't terminate after %gs" % (" and ".join(stuck), self._tjoin_timeout))
+            self._stop = Event()
+            return False
+        stop.clear()
+        return True
+
+    # Release what the phone holds for its whole life: wait for outstanding post-processing (which still needs the recording index) to finish
+    # and close the wakeup pipe. Call stop() first. If a runner thread is still stuck the pipe is left open, since it may be selecting on it.
+    def close(self):
+        if self._post_processor: self._post_processor.shutdown(wait=True)
+        if any(thread and thread.is_alive() for thread in (self._play_thread, self._rcrd_thread)):
+            self._logger.error("Not closing the wakeup pipe since a runner thread is still running")
+        elif self._wake_r is not None:
+            os.close(self._wake_r)
+            os.close(self._wake_w)
+            self._wake_r = self._wake_w = None
+        if self._replay_dir: shutil.rmtree(self._replay_dir, ignore_errors=True)
+
+    # Empty the wakeup pipe once every runner thread has seen the stop request so that the next play/record doesn't wake up immediately.
+    def _drain_wakeup(self):
+        try:
+            while os.read(self._wake_r, 64): pass
+        except BlockingIOError:
+            pass
 
     # Helper function to get the path of the second-last successful recording. This is used to play the previously recorded message when the
-    # special key chord is pressed.
+    # special key chord is pressed. The recording index is used if there is one so that this still works after a restart, in which case the
+    # newest playable recording other than the one just made is returned, skipping any that silence detection found to be empty. If it has
+    # been archived it is extracted first.
     def getSecondLastRecording(self):
-        if len(self._rcrd_list) > 1:
-            return self._rcrd_list[len(self._rcrd_list) - 2]
+        if self._index:
+            current = self._rcrd_list[-1] if self._rcrd_list else None
+            rows = [row for row in self._index.recent(2, statuses=recordings.playable_statuses) if row["path"] != current]
+            if not rows: return None
+            if rows[0]["archive"] and self._replay_dir is None: self._replay_dir = tempfile.mkdtemp(prefix="phony_replay_")
+            return storage.playable_path(rows[0], self._replay_dir)
         else:
-            return None
+            # Skip over any that silence detection has discarded
+            return next((path for path in reversed(self._rcrd_list[:-1]) if os.path.exists(path)), None)
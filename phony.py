@@ -1,11 +1,13 @@
 #!/usr/bin/python
-import logging, util, os, re, signal, code
+import time
+from time import sleep, monotonic
+imports_start = monotonic() # Everything before this is the interpreter starting up
+import logging, util, signal, os, socket, atexit, encoder, metrics, storage, lines, server
 from argparse import ArgumentParser, RawTextHelpFormatter
-from time import sleep
+from importlib import import_module
+from threading import Thread
 from pathlib import Path
 from datetime import datetime
-from phone import Phone
-from gpiozero import Button
 
 # Script constants
 this_script_path          = Path(__file__).resolve()
@@ -13,10 +15,7 @@ this_script_dir           = this_script_path.parent.resolve()
 this_script_filename      = this_script_path.name
 output_path_root          = Path(this_script_dir, 'out').resolve()
 greeting_msg_path         = Path(this_script_dir, 'greeting.wav').resolve()
-handset_button_pin        = 14
-handset_button_debounce_s = 0.2
-secret_button_pin         = 12
-secret_button_debounce_s  = 1
+startup_budget_s          = 10 # A warning is logged if it takes longer than this from the process starting to being ready for calls
 
 # Handle SIGINT signals (ex: user presses CTRL + C) to exit gracefully.
 def sigint_handler(signum, frame):
@@ -31,68 +30,179 @@ def parse_args():
     desc_str = ("Implements a telephone message recorder\n\n")
     parser = ArgumentParser(formatter_class=RawTextHelpFormatter, description=desc_str)
     parser.add_argument("-o", "--output", type=str, default=output_path_root, help="The directory to output recorded audio files and the log (default=%(default)s)")
+    parser.add_argument("--lines", type=str, default=None, help="A JSON file configuring each handset's pins, sound card and output directory, for\n"
+                                                                "running several phones from one host. Without it a single phone uses the\n"
+                                                                "original pins and sound card and records to --output")
+    parser.add_argument("--audio-backend", choices=["alsa", "process", "file"], default="alsa", help="How audio is played and recorded. 'alsa' keeps the sound card open and streams\n"
+                                                                                                      "audio in-process, 'process' spawns aplay/arecord for every call and 'file'\n"
+                                                                                                      "plays to /dev/null and records silence, for testing (default=%(default)s)")
+    parser.add_argument("--format", choices=["wav"] + list(encoder.formats), default="wav", help="The format recordings are saved in. Compressed\n"
+                                                                                                   "formats are encoded as they are recorded (default=%(default)s)")
+    parser.add_argument("--trim-silence", action="store_true", help="If specified, trim the silence from the start and end of each recording and\n"
+                                                                    "save the speech detection results next to it (needs NumPy)")
+    parser.add_argument("--empty-calls", choices=["flag", "discard"], default="flag", help="What to do with recordings that have no speech in them\n"
+                                                                                            "when --trim-silence is given (default=%(default)s)")
+    parser.add_argument("--quota", type=storage.parse_size, default=None, help="The most space the output directory may use, e.g. 8G. The oldest data is\n"
+                                                                              "evicted to stay under it")
+    parser.add_argument("--quota-percent", type=float, default=None, help="Evict the oldest data while the filesystem is fuller than this percentage")
+    parser.add_argument("--eviction", choices=storage.eviction_policies, default="oldest", help="What to evict first when over quota. 'empty-first'\n"
+                                                                                                 "evicts recordings without speech first, 'none' never\n"
+                                                                                                 "deletes anything (default=%(default)s)")
+    parser.add_argument("--archive-after-days", type=float, default=0, help="Pack recordings older than this into zip archives in the archive\n"
+                                                                            "directory of the output directory. 0 disables archiving (default=%(default)s)")
+    parser.add_argument("--log-max-age-days", type=float, default=0, help="Delete compressed logs older than this. 0 keeps them forever\n"
+                                                                          "(default=%(default)s)")
+    parser.add_argument("--metrics", action="store_true", help="If specified, collect call metrics and write them to phony.prom in the output\n"
+                                                               "directory in the Prometheus text format")
+    parser.add_argument("--metrics-port", type=int, default=None, help="If specified, also serve the metrics at http://localhost:<port>/metrics")
+    parser.add_argument("--serve-port", type=int, default=None, help="If specified, serve the recordings and their metadata at http://<address>:<port>/")
+    parser.add_argument("--serve-address", type=str, default="127.0.0.1", help="The address to serve the recordings on. Use 0.0.0.0 to make them\n"
+                                                                             "available to the rest of the network (default=%(default)s)")
+    parser.add_argument("--serve-busy-rate", type=storage.parse_size, default=0, help="How many bytes/s a download may continue at while a call is in\n"
+                                                                                    "progress, e.g. 200K. 0 pauses downloads until the call ends\n"
+                                                                                    "(default=%(default)s)")
+    parser.add_argument("--trace-edges", type=str, default=None, help="If specified, append every button edge to this file as '<time> <line> <edge>',\n"
+                                                                 "for replaying with 'bench.py -s trace --trace <file>'")
+    parser.add_argument("--ready-file", type=str, default=None, help="If specified, this file is created once phony is ready to take calls and removed\n"
+                                                                   "when it exits. systemd is notified as well if phony is run as a Type=notify service")
+    parser.add_argument("--profile-startup", action="store_true", help="If specified, print how long each step of startup took once phony is ready and\n"
+                                                                     "exit, before notifying anyone or starting the storage manager")
     parser.add_argument("--debug", action="store_true", help="If specified, log messages at DEBUG level and higher will be printed to the console")
     return parser.parse_args()
 
-# Look through output_path_root to determine the number the last recording started with and generate a new filename
-def get_new_filename(logger, out_dir):
-    logger.debug("Determining next recording filename")
+# Start collecting metrics and exporting them to a textfile in the output directory and, optionally, over HTTP on localhost
+def start_metrics(logger, out_dir, port=None):
+    registry = metrics.enable()
+    registry.add_collector(lambda: metrics.set_total("phony_log_messages_dropped_total", util.log_queue_handler.dropped))
+    metrics.TextfileExporter(path=Path(out_dir, "phony.prom")).start()
+    if port is not None:
+        try:
+            metrics.serve_http(port=port)
+        except OSError as err:
+            logger.error("Unable to serve metrics on port %d: %s" % (port, err))
+
+# Import gpiozero on a background thread so that it loads while the rest of startup is waiting on the SD card and the sound card. Line.arm()
+# imports it again, which waits for this import to finish if it hasn't already, and reports any error.
+def start_gpio_import():
+    def import_gpiozero():
+        try:
+            import_module("gpiozero")
+        except Exception:
+            pass
+    Thread(target=import_gpiozero, name="GPIO Import", daemon=True).start()
+
+# Return how long ago this process was started (including the interpreter's own startup) according to /proc, or None if that isn't available
+def process_age():
+    now = boot_time()
+    if now is None: return None
     try:
-        outdir_contents = os.listdir(path=out_dir)
-    except Exception as err:
-        logger.error("A %s exception was raised while trying to list the contents of directory %s" % (type(err).__name__, outdir_contents))
-        raise
-
-    # Iterate through the list of outdir_contents to find the highest numbered directory
-    last_dir_num = 0
-    for obj in outdir_contents:
-        matched = re.match(pattern="^([0-9]+)_", string=obj)
-
-        # matched[1] corresponds to the first capture group
-        if matched is not None and matched[1] is not None and int(matched[1]) > last_dir_num:
-            last_dir_num = int(matched[1])
-
-    new_file_name = "%d_Recording_%s.wav" % (last_dir_num + 1, datetime.now().strftime("%d%b%y-%H%M%S"))
-    logger.debug("Last recording number was %d. Using new filename %s" % (last_dir_num, new_file_name))
-    return str(Path(out_dir, new_file_name).resolve())
-
-# This function gets called by the gpiozero library when the handset is lifted off the receiver. It simultaneously initiates playback
-# of the greeting message from the handset speaker and starts recording from the handset microphone.
-def handset_up(button, phone_manager, logger, out_dir):
-    new_file_name = get_new_filename(logger=logger, out_dir=out_dir)
-    phone_manager.play(audio_file=greeting_msg_path)
-    phone_manager.record(audio_file=new_file_name)
-
-# This function is called by the gpiozero library when the handset is placed down onto the receiver. It halts any ongoing playback and
-# recording threads.
-def handset_down(button, phone_manager):
-    phone_manager.stop()
-
-# This function is called by the gpiozero library when the special key chord combination is pressed on the phone receiver. It stops any
-# ongoing threads and then initiates playback of the second-last recording (since the first-last will be the one that was just terminated).
-def play_last_recording(button, phone_manager):
-    phone_manager.stop()
-    second_last_recording = phone_manager.getSecondLastRecording()
-    phone_manager.play(audio_file=second_last_recording)
-
-# Main program loop. It parses input arguments, initiates the logger, and registers callback functions in the gpiozero library to be called
-# upon button activations.
+        with open("/proc/self/stat") as f:
+            start_ticks = int(f.read().rsplit(")", 1)[1].split()[19])
+        return now - start_ticks / os.sysconf("SC_CLK_TCK")
+    except (OSError, ValueError, IndexError):
+        return None
+
+# Return the time since boot, or None if the platform has no CLOCK_BOOTTIME (it is Linux only)
+def boot_time():
+    clock = getattr(time, "CLOCK_BOOTTIME", None)
+    return time.clock_gettime(clock) if clock is not None else None
+
+# Records how long each step of startup takes
+class StartupTimer():
+    def __init__(self):
+        self.steps = []
+        self._last = imports_start
+
+    def step(self, name):
+        now = monotonic()
+        self.steps.append((name, now - self._last))
+        self._last = now
+
+    # Return the steps with the interpreter's startup (before phony.py began running) added at the front if it could be measured
+    def report(self):
+        age = process_age()
+        interpreter = [("interpreter", age - (monotonic() - imports_start))] if age is not None else []
+        return interpreter + self.steps
+
+# Tell systemd (if phony was started as a Type=notify service with NOTIFY_SOCKET set) and anyone watching ready_file that phony is ready
+def notify_ready(logger, ready_file=None, status="Ready"):
+    address = os.environ.get("NOTIFY_SOCKET")
+    if address:
+        if address.startswith("@"): address = "\0" + address[1:] # Abstract namespace socket
+        try:
+            with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as sock:
+                sock.sendto(("READY=1\nSTATUS=%s\nMAINPID=%d" % (status, os.getpid())).encode(), address)
+        except OSError as err:
+            logger.error("Unable to notify systemd: %s" % err)
+    if ready_file:
+        tmp_path = ready_file + ".tmp"
+        with open(tmp_path, "w") as f:
+            f.write("%d\n%s\n" % (os.getpid(), status))
+        os.replace(tmp_path, ready_file)
+        atexit.register(lambda: os.path.exists(ready_file) and os.remove(ready_file))
+
+# Main program loop. It parses input arguments, initiates the logger, and opens a line (with its own buttons, Phone and recording index) for
+# each configured handset.
+# Startup is ordered so that phony can answer a call as soon as possible: gpiozero loads in the background, everything the first call touches
+# is prewarmed, and the storage manager only starts once phony has reported that it is ready.
 if (__name__ == "__main__"):
+    timer = StartupTimer()
+    timer.step("imports")
     args = parse_args()
+    if args.ready_file and os.path.exists(args.ready_file): os.remove(args.ready_file) # Left behind if phony was killed
+    start_gpio_import()
     util.init_logging(console_level=(logging.DEBUG if args.debug else logging.INFO), logfile=True, logfile_dir=output_path_root)
     logger = logging.getLogger(name=this_script_filename)
 
     start_time = datetime.now()
     logger.info("Program started at %s" % (start_time.now().strftime("%H:%M:%S on %d %B %Y")))
+    if args.metrics or args.metrics_port is not None:
+        start_metrics(logger=logger, out_dir=args.output, port=args.metrics_port)
+    timer.step("logging and metrics")
+
+    if args.lines:
+        configs = lines.load_config(args.lines)
+    else:
+        configs = [lines.line_config(name="1", out_dir=str(args.output), greeting=str(greeting_msg_path))]
+    line_manager = lines.LineManager(configs, audio_backend=args.audio_backend,
+                                     phone_options=dict(record_format=args.format, trim_silence=args.trim_silence, empty_calls=args.empty_calls),
+                                     storage_options=dict(quota_bytes=args.quota, quota_percent=args.quota_percent, eviction=args.eviction,
+                                                          archive_after_days=args.archive_after_days, log_max_age_days=args.log_max_age_days,
+                                                          active_log=util.log_file_path),
+                                     trace=open(args.trace_edges, "a", buffering=1) if args.trace_edges else None)
+    line_manager.open(arm=False)
+    timer.step("open lines")
+    line_manager.arm()
+    timer.step("arm")
+    line_manager.prewarm()
+    timer.step("prewarm")
+
+    steps = timer.report()
+    total_s = sum(duration for _, duration in steps)
+    if args.profile_startup:
+        # Exit before reporting ready or starting anything in the background, such as a storage pass that would be cut off part way
+        for name, duration in steps:
+            print("%-20s %8.1f ms" % (name, duration * 1000))
+        print("%-20s %8.1f ms" % ("total", total_s * 1000))
+        exit()
 
-    phone_manager = Phone()
-    handset_button = Button(pin=handset_button_pin, pull_up=True, bounce_time=handset_button_debounce_s)
-    handset_button.when_activated = lambda: handset_up(button=handset_button, phone_manager=phone_manager, logger=logger, out_dir=args.output)
-    handset_button.when_deactivated = lambda: handset_down(button=handset_button, phone_manager=phone_manager)
-    secret_button = Button(pin=secret_button_pin, pull_up=True, bounce_time=secret_button_debounce_s)
-    secret_button.when_activated = lambda: play_last_recording(button=secret_button, phone_manager=phone_manager)
+    status = "Ready for calls %.2f s after starting" % total_s
+    if boot_time() is not None: status += " (%.1f s after boot)" % boot_time()
+    notify_ready(logger=logger, ready_file=args.ready_file, status=status)
+    logger.info(status)
+    if total_s > startup_budget_s: logger.warning("Startup took longer than its %d s budget" % startup_budget_s)
+    line_manager.start_storage()
+    if args.serve_port is not None:
+        recording_server = server.RecordingServer(indexes={line.name: line.recording_index for line in line_manager.lines}, port=args.serve_port,
+                                                  address=args.serve_address, busy=line_manager.busy, busy_rate=args.serve_busy_rate,
+                                                  post_processing=line_manager.post_processing)
+        try:
+            recording_server.start()
+        except OSError as err:
+            logger.error("Unable to serve recordings on port %d: %s" % (args.serve_port, err))
 
     if args.debug:
+        import code
         code.interact(banner="\n", local=locals()) # Enter interactive Python interpreter
 
     # Main thread loop. Nothing to do except wait for a the OS to eventually kill us
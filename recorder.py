@@ -0,0 +1,223 @@
+import logging, struct, os
+from time import monotonic
+from threading import Thread, Condition
+import audio
+
+# WAV layout used by the recorder. A 'JUNK' padding chunk is placed between the 'fmt ' chunk and the 'data' chunk so that the sample data
+# starts on a block boundary, which lets every chunk the writer thread hands to the SD card be block aligned. WAV readers skip unknown chunks.
+block_size       = 4096
+data_offset      = block_size
+riff_size_offset = 4
+junk_size        = data_offset - 12 - 24 - 8 - 8 # RIFF header, 'fmt ' chunk, JUNK chunk header, data chunk header
+data_size_offset = data_offset - 4
+
+def wav_header(data_size=0, rate=audio.sample_rate, nchannels=audio.channels, width=audio.sample_width):
+    return (struct.pack("<4sI4s", b"RIFF", data_offset - 8 + data_size, b"WAVE") +
+            struct.pack("<4sIHHIIHH", b"fmt ", 16, 1, nchannels, rate, rate * nchannels * width, nchannels * width, width * 8) +
+            struct.pack("<4sI", b"JUNK", junk_size) + bytes(junk_size) +
+            struct.pack("<4sI", b"data", data_size))
+
+# Recorder output that writes raw frames into a WAV file. Each sync() rewrites the header sizes to cover everything written so far and
+# flushes the file to the card, so the file on disk is always a valid WAV up to the last sync.
+class WavFile():
+    def __init__(self, path):
+        self._file = open(path, "w+b", buffering=0)
+        self._file.write(wav_header())
+        self._data_size = 0
+
+    def write(self, data):
+        self._file.write(data)
+        self._data_size += len(data)
+
+    def sync(self):
+        self._file.seek(riff_size_offset)
+        self._file.write(struct.pack("<I", data_offset - 8 + self._data_size))
+        self._file.seek(data_size_offset)
+        self._file.write(struct.pack("<I", self._data_size))
+        self._file.seek(0, os.SEEK_END)
+        os.fsync(self._file.fileno())
+
+    def close(self):
+        self.sync()
+        self._file.close()
+
+# Write-behind recorder. The real-time capture thread (the audio engine's capture pump or the _cmd_runner thread reading arecord) calls
+# write(), which only copies the frames into a preallocated ring buffer and never touches the disk. A separate writer thread drains the ring
+# to the output in large block-aligned chunks and syncs it in batches. If the ring fills up because the SD card (or the encoder) stalled,
+# the frames are dropped and counted as an overrun rather than blocking the capture thread. The output defaults to a WavFile at path; any
+# object with the same write()/sync()/close() methods can be given instead, e.g. an encoder.EncoderPipe. If an analyzer is given (such as a
+# silence.SilenceDetector) every chunk is passed to its feed() method on the writer thread, just before it is written out. If writing to the
+# output fails (e.g. the SD card is full or the encoder died) the writer keeps draining the ring and discards what it takes, so the capture
+# thread isn't left counting every frame as an overrun, and close() raises the error once the output has been closed.
+class BufferedRecorder():
+    def __init__(self, path, output=None, analyzer=None, ring_bytes=4 * 1024 * 1024, chunk_bytes=64 * 1024, fsync_interval_s=2.0):
+        self._logger = logging.getLogger("Recorder")
+        self._path = path
+        self._ring = bytearray(ring_bytes)
+        self._ring_view = memoryview(self._ring)
+        self._head = 0 # Total bytes ever written into the ring
+        self._tail = 0 # Total bytes ever drained from the ring
+        self._chunk_bytes = chunk_bytes
+        self._fsync_interval_s = fsync_interval_s
+        self._cond = Condition()
+        self._closing = False
+        self._error = None # The first exception raised by the output, after which everything captured is discarded
+        self._stats = {"overruns": 0, "dropped_bytes": 0, "high_water_bytes": 0, "bytes_written": 0, "writes": 0, "fsyncs": 0,
+                       "write_latency_max_s": 0.0, "write_latency_total_s": 0.0, "analyzer_failed": False}
+
+        self._output = output or WavFile(path)
+        self._analyzer = analyzer
+        self._writer_thread = Thread(target=self._writer, name="Recorder Writer", daemon=True)
+        self._writer_thread.start()
+
+    # Copy captured frames into the ring buffer. Called from the real-time capture thread, so it never blocks on I/O.
+    def write(self, data):
+        with self._cond:
+            free = len(self._ring) - (self._head - self._tail)
+            if len(data) > free:
+                self._stats["overruns"] += 1
+                self._stats["dropped_bytes"] += len(data)
+                return
+            start = self._head % len(self._ring)
+            first = min(len(data), len(self._ring) - start)
+            self._ring_view[start:start + first] = data[:first]
+            self._ring_view[:len(data) - first] = data[first:]
+            self._head += len(data)
+            used = self._head - self._tail
+            if used > self._stats["high_water_bytes"]: self._stats["high_water_bytes"] = used
+            if used >= self._chunk_bytes: self._cond.notify()
+
+    def _take(self, size):
+        start = self._tail % len(self._ring)
+        first = min(size, len(self._ring) - start)
+        data = bytes(self._ring_view[start:start + first]) + bytes(self._ring_view[:size - first])
+        self._tail += size
+        return data
+
+    def _writer(self):
+        last_sync = monotonic()
+        while True:
+            with self._cond:
+                if self._head - self._tail < self._chunk_bytes and not self._closing:
+                    self._cond.wait(timeout=self._fsync_interval_s)
+                used = self._head - self._tail
+                closing = self._closing
+                # Only write whole blocks while recording; whatever is left over goes out in the final write
+                size = used if closing else used - used % block_size
+                data = self._take(size) if size else b""
+
+            if self._error:
+                if closing: return
+                continue
+            if data and self._analyzer:
+                try:
+                    self._analyzer.feed(data)
+                except Exception as err:
+                    # Losing the analysis is better than losing the recording, so carry on without it
+                    self._logger.error("Analyzer failed on %s, disabling it: %s: %s" % (self._path, type(err).__name__, err))
+                    self._analyzer = None
+                    self._stats["analyzer_failed"] = True
+            try:
+                if data:
+                    start = monotonic()
+                    self._output.write(data)
+                    latency = monotonic() - start
+                    self._stats["bytes_written"] += len(data)
+                    self._stats["writes"] += 1
+                    self._stats["write_latency_total_s"] += latency
+                    if latency > self._stats["write_latency_max_s"]: self._stats["write_latency_max_s"] = latency
+                if closing:
+                    return
+                if monotonic() - last_sync >= self._fsync_interval_s:
+                    self._output.sync()
+                    self._stats["fsyncs"] += 1
+                    last_sync = monotonic()
+            except Exception as err:
+                self._logger.error("Unable to write %s, discarding the rest of the recording: %s: %s" % (self._path, type(err).__name__, err))
+                self._error = err
+                if closing: return
+
+    # Drain everything that is left in the ring and close the output, which finalizes the file. Returns the recorder statistics, or raises the
+    # error that stopped the writer (stats() still has the statistics).
+    def close(self):
+        with self._cond:
+            self._closing = True
+            self._cond.notify()
+        self._writer_thread.join()
+        try:
+            self._output.close()
+            self._stats["fsyncs"] += 1
+        except Exception as err:
+            if self._error is None: raise
+            self._logger.debug("Closing %s after a write error also failed: %s" % (self._path, err))
+        self._logger.info("Closed %s. %d bytes written, %d overruns (%d bytes dropped), ring high-water mark %d bytes, max write latency %.1f ms" %
+                          (self._path, self._stats["bytes_written"], self._stats["overruns"], self._stats["dropped_bytes"],
+                           self._stats["high_water_bytes"], self._stats["write_latency_max_s"] * 1000))
+        if self._error: raise self._error
+        return self.stats()
+
+    def stats(self):
+        with self._cond:
+            return dict(self._stats)
+
+# Find the data chunk of an open WAV file. Returns (offset of the chunk header, size recorded in the header, block align), or None if the file
+# isn't a WAV file or has no data chunk.
+def find_data_chunk(f):
+    f.seek(0)
+    riff = f.read(12)
+    if len(riff) < 12 or riff[:4] != b"RIFF" or riff[8:] != b"WAVE": return None
+    block_align = audio.frame_bytes
+    while True:
+        chunk_pos = f.tell()
+        chunk = f.read(8)
+        if len(chunk) < 8: return None
+        chunk_id, chunk_size = struct.unpack("<4sI", chunk)
+        if chunk_id == b"fmt ":
+            block_align = struct.unpack("<HHIIH", f.read(14))[4]
+        elif chunk_id == b"data":
+            return chunk_pos, chunk_size, block_align
+        f.seek(chunk_pos + 8 + chunk_size + (chunk_size & 1))
+
+def _set_data_size(f, chunk_pos, data_size):
+    f.seek(chunk_pos + 4)
+    f.write(struct.pack("<I", data_size))
+    f.seek(riff_size_offset)
+    f.write(struct.pack("<I", chunk_pos + data_size))
+
+# Fix up the RIFF and data chunk sizes of a WAV file that wasn't finalized, e.g. because phony crashed or lost power mid-recording. The data
+# chunk is taken to run to the end of the file (truncated to a whole number of frames). Returns True if the header was changed.
+def repair_wav(path):
+    with open(path, "r+b") as f:
+        file_size = f.seek(0, os.SEEK_END)
+        found = find_data_chunk(f)
+        if found is None: return False
+        chunk_pos, chunk_size, block_align = found
+        f.seek(riff_size_offset)
+        riff_size = struct.unpack("<I", f.read(4))[0]
+        data_size = file_size - (chunk_pos + 8)
+        data_size -= data_size % block_align
+        if (chunk_size, riff_size) == (data_size, chunk_pos + data_size): return False
+        _set_data_size(f, chunk_pos, data_size)
+        return True
+
+# Cut a WAV file down to the frames between start and end, in place. The kept audio is copied down over the part being cut from the front in
+# chunk_bytes pieces, so only one chunk is ever held in memory, and then the file is truncated. If this is interrupted part way the header
+# still describes the untrimmed length, so at worst the file ends up with some audio repeated where the cut silence used to be.
+def trim_wav(path, start, end, chunk_bytes=1024 * 1024):
+    with open(path, "r+b") as f:
+        found = find_data_chunk(f)
+        if found is None: raise ValueError("%s is not a WAV file" % path)
+        chunk_pos, chunk_size, block_align = found
+        data_pos = chunk_pos + 8
+        start, end = start * block_align, min(end * block_align, chunk_size - chunk_size % block_align)
+        if start >= end: start = end = 0
+        if start:
+            for offset in range(0, end - start, chunk_bytes):
+                f.seek(data_pos + start + offset)
+                data = f.read(min(chunk_bytes, end - start - offset))
+                f.seek(data_pos + offset)
+                f.write(data)
+        f.truncate(data_pos + end - start)
+        _set_data_size(f, chunk_pos, end - start)
+        f.flush()
+        os.fsync(f.fileno())
@@ -0,0 +1,239 @@
+import logging, sqlite3, os, re, wave, zipfile
+from time import time, mktime
+from datetime import datetime
+from pathlib import Path
+from threading import Lock
+from recorder import repair_wav
+
+# Recording status values stored in the index
+STATUS_RECORDING   = "recording"   # Recording is in progress (or phony died while it was)
+STATUS_PROCESSING  = "processing"  # Recorder finished cleanly and the recording is being post-processed (trimmed) before it is complete
+STATUS_COMPLETE    = "complete"    # Recorder finished cleanly
+STATUS_FAILED      = "failed"      # Recorder returned an error
+STATUS_INTERRUPTED = "interrupted" # Found in the 'recording' state at startup, i.e. phony crashed or lost power mid-call
+STATUS_RECOVERED   = "recovered"   # Found in the output directory while rebuilding a missing index
+STATUS_EMPTY       = "empty"       # Kept, but silence detection found no speech in it
+STATUS_DISCARDED   = "discarded"   # Deleted because silence detection found no speech in it
+STATUS_EVICTED     = "evicted"     # Deleted by the storage manager to stay within the storage quota
+STATUS_SKIPPED     = "skipped"     # Not recorded because there wasn't enough free space or the last recording hadn't stopped
+
+# Statuses of recordings that have something worth playing back
+playable_statuses = (STATUS_COMPLETE, STATUS_FAILED, STATUS_INTERRUPTED, STATUS_RECOVERED)
+
+# Statuses of recordings that have no file (or archive member) any more
+gone_statuses = (STATUS_DISCARDED, STATUS_EVICTED, STATUS_SKIPPED)
+
+# Statuses of recordings whose file is still being written to, so nothing else may read, move or change it
+unfinished_statuses = (STATUS_RECORDING, STATUS_PROCESSING)
+
+filename_pattern = re.compile("^([0-9]+)_")
+archive_dir_name = "archive"
+
+# Persistent index of the recordings in an output directory, stored in an SQLite database alongside them. It hands out recording sequence
+# numbers from an in-memory counter (so no directory listing is needed on pickup) and keeps per-recording metadata that survives restarts.
+# If the database is missing or unreadable it is rebuilt from the contents of the directory. Recordings that the storage manager has packed into
+# a segment archive keep their original path and have the archive's path in the 'archive' column.
+class RecordingIndex():
+    def __init__(self, out_dir, db_name="recordings.db"):
+        self._logger = logging.getLogger("Recording Index")
+        self._out_dir = Path(out_dir)
+        self._db_path = Path(out_dir, db_name)
+        self._lock = Lock()
+        self._db = None
+        self._next_seq = 1
+
+    # Open the index, rebuilding it if need be. Unless recover is False, recordings still marked as recording are taken to have been cut off by
+    # a crash and are repaired, and those still being post-processed are marked complete. Tools that may run alongside phony pass recover=False so that they don't mistake the live call for one.
+    def open(self, recover=True):
+        rebuild = not self._db_path.exists()
+        try:
+            self._connect()
+        except sqlite3.DatabaseError as err:
+            self._logger.error("Recording index %s is unreadable (%s). Moving it aside and rebuilding" % (self._db_path, err))
+            if self._db: self._db.close()
+            os.replace(self._db_path, str(self._db_path) + ".corrupt")
+            self._connect()
+            rebuild = True
+        if rebuild: self.rebuild()
+
+        # Anything still marked as recording was cut off by a crash or power loss
+        with self._lock, self._db:
+            interrupted = self._db.execute("SELECT seq, path FROM recordings WHERE status = ?", (STATUS_RECORDING, )).fetchall() if recover else []
+            for seq, path in interrupted:
+                self._logger.warning("Recording %d (%s) was interrupted" % (seq, path))
+                try:
+                    if repair_wav(path): self._logger.info("Repaired the WAV header of %s" % path)
+                except OSError as err:
+                    self._logger.error("Unable to repair %s: %s" % (path, err))
+                self._update_file_stats(seq, path, STATUS_INTERRUPTED)
+            # A recording whose post-processing was cut off was recorded in full. trim_wav() leaves a playable file if it is interrupted.
+            processing = self._db.execute("SELECT seq, path FROM recordings WHERE status = ?", (STATUS_PROCESSING, )).fetchall() if recover else []
+            for seq, path in processing:
+                self._logger.warning("Post-processing of recording %d (%s) was interrupted" % (seq, path))
+                self._db.execute("UPDATE recordings SET status = ?, size = COALESCE(?, size) WHERE seq = ?",
+                                 (STATUS_COMPLETE, os.path.getsize(path) if os.path.exists(path) else None, seq))
+            self._next_seq = self._db.execute("SELECT COALESCE(MAX(seq), 0) + 1 FROM recordings").fetchone()[0]
+        self._logger.debug("Recording index %s opened. Next sequence number is %d" % (self._db_path, self._next_seq))
+
+    def _connect(self):
+        self._db = None
+        self._db = sqlite3.connect(str(self._db_path), check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")     # Readers never block the writer and each commit is a single append to the WAL
+        # NORMAL would only sync the WAL at checkpoints, so a power cut (the usual way this device is switched off) could lose the latest commits
+        # and allocate() would hand out a sequence number whose file is already on disk. One sync per call is cheap.
+        self._db.execute("PRAGMA synchronous=FULL")
+        self._db.execute("CREATE TABLE IF NOT EXISTS recordings (seq INTEGER PRIMARY KEY, path TEXT NOT NULL, status TEXT NOT NULL, "
+                         "start_time REAL, end_time REAL, duration REAL, size INTEGER)")
+        if "archive" not in [column[1] for column in self._db.execute("PRAGMA table_info(recordings)")]:
+            self._db.execute("ALTER TABLE recordings ADD COLUMN archive TEXT") # Databases created before recordings were archived
+        self._db.isolation_level = "DEFERRED"
+
+    def close(self):
+        with self._lock:
+            if self._db: self._db.close()
+            self._db = None
+
+    # Repopulate the index from the recordings found in the output directory and its segment archives. Only done when the database is missing,
+    # so it is the one place that still needs to list the directory.
+    def rebuild(self):
+        self._logger.info("Rebuilding recording index from %s" % self._out_dir)
+        rows = []
+        for entry in os.scandir(self._out_dir):
+            matched = filename_pattern.match(entry.name)
+            if matched is None or entry.name.endswith((".json", ".tmp")) or not entry.is_file(): continue # Skip sidecar files
+            stat = entry.stat()
+            rows.append((int(matched[1]), str(Path(entry.path).resolve()), STATUS_RECOVERED, None, stat.st_mtime, wav_duration(entry.path),
+                         stat.st_size, None))
+        archive_dir = Path(self._out_dir, archive_dir_name)
+        for archive in (sorted(archive_dir.glob("*.zip")) if archive_dir.is_dir() else []):
+            try:
+                with zipfile.ZipFile(archive) as zf:
+                    for info in zf.infolist():
+                        matched = filename_pattern.match(info.filename)
+                        if matched is None or info.filename.endswith(".json"): continue
+                        rows.append((int(matched[1]), str(Path(self._out_dir, info.filename).resolve()), STATUS_RECOVERED, None,
+                                     mktime(info.date_time + (0, 0, -1)), None, info.file_size, str(archive.resolve())))
+            except (OSError, zipfile.BadZipFile) as err:
+                self._logger.error("Unable to read archive %s: %s" % (archive, err))
+        with self._lock, self._db:
+            self._db.executemany("INSERT OR IGNORE INTO recordings (seq, path, status, start_time, end_time, duration, size, archive) "
+                                 "VALUES (?, ?, ?, ?, ?, ?, ?, ?)", rows)
+        self._logger.info("Recovered %d recordings" % len(rows))
+
+    # Reserve the next sequence number and return it along with the path of the new recording, which follows the same
+    # '<seq>_Recording_<timestamp>.wav' naming scheme as always.
+    def allocate(self, ext=".wav"):
+        with self._lock, self._db:
+            seq = self._next_seq
+            self._next_seq += 1
+            path = self._recording_path(seq, ext)
+            self._db.execute("INSERT INTO recordings (seq, path, status, start_time) VALUES (?, ?, ?, ?)", (seq, path, STATUS_RECORDING, time()))
+        self._logger.debug("Allocated recording %d: %s" % (seq, path))
+        return seq, path
+
+    def _recording_path(self, seq, ext):
+        return str(Path(self._out_dir, "%d_Recording_%s%s" % (seq, datetime.now().strftime("%d%b%y-%H%M%S"), ext)).resolve())
+
+    # Go through the motions of allocate() in a transaction that is rolled back, so that the first pickup finds the statement compiled and the
+    # database pages it touches already in the page cache, without using up a sequence number
+    def prewarm(self, ext=".wav"):
+        with self._lock:
+            try:
+                self._db.execute("INSERT INTO recordings (seq, path, status, start_time) VALUES (?, ?, ?, ?)",
+                                 (self._next_seq, self._recording_path(self._next_seq, ext), STATUS_RECORDING, time()))
+            finally:
+                self._db.rollback()
+
+    # Mark a recording as finished and fill in its end time, duration and size from the file on disk. The duration is read from the WAV
+    # header unless it is given, which it has to be for compressed recordings.
+    def finish(self, seq, status=STATUS_COMPLETE, duration=None):
+        with self._lock, self._db:
+            row = self._db.execute("SELECT path FROM recordings WHERE seq = ?", (seq, )).fetchone()
+            if row: self._update_file_stats(seq, row[0], status, duration)
+
+    def _update_file_stats(self, seq, path, status, duration=None):
+        try:
+            size = os.path.getsize(path)
+        except OSError:
+            size = None
+        if duration is None: duration = wav_duration(path)
+        self._db.execute("UPDATE recordings SET status = ?, end_time = ?, duration = ?, size = ? WHERE seq = ?",
+                         (status, time(), duration, size, seq))
+
+    # Update the path (and size) of a recording, e.g. after it has been moved or converted
+    def set_path(self, seq, path):
+        try:
+            size = os.path.getsize(path)
+        except OSError:
+            size = None
+        with self._lock, self._db:
+            self._db.execute("UPDATE recordings SET path = ?, size = COALESCE(?, size) WHERE seq = ?", (str(path), size, seq))
+
+    # Update the status and/or duration of a recording after it has been post-processed (e.g. trimmed or discarded by silence detection) and
+    # refresh its size from the file on disk
+    def update(self, seq, status=None, duration=None):
+        with self._lock, self._db:
+            row = self._db.execute("SELECT path FROM recordings WHERE seq = ?", (seq, )).fetchone()
+            if row is None: return
+            try:
+                size = os.path.getsize(row[0])
+            except OSError:
+                size = None
+            self._db.execute("UPDATE recordings SET status = COALESCE(?, status), duration = COALESCE(?, duration), size = ? WHERE seq = ?",
+                             (status, duration, size, seq))
+
+    # Return every finished recording that still has a file or archive member, oldest first, optionally only those that finished before the
+    # given time
+    def stored(self, before=None):
+        query, args = "SELECT * FROM recordings WHERE status NOT IN (%s)" % ",".join("?" * (len(unfinished_statuses) + len(gone_statuses))), \
+                      unfinished_statuses + gone_statuses
+        if before is not None:
+            query += " AND end_time < ?"
+            args += (before, )
+        with self._lock:
+            cursor = self._db.execute(query + " ORDER BY seq", args)
+            rows = cursor.fetchall()
+        return [dict(zip([c[0] for c in cursor.description], row)) for row in rows]
+
+    # Record that the given recordings have been packed into a segment archive
+    def set_archive(self, seqs, archive):
+        with self._lock, self._db:
+            self._db.executemany("UPDATE recordings SET archive = ? WHERE seq = ?", [(str(archive), seq) for seq in seqs])
+
+    # Record that the given recordings have been deleted by the storage manager
+    def evict(self, seqs):
+        with self._lock, self._db:
+            self._db.executemany("UPDATE recordings SET status = ?, size = NULL WHERE seq = ?", [(STATUS_EVICTED, seq) for seq in seqs])
+
+    # Return the row for the given sequence number as a dict, or None if there is no such recording
+    def get(self, seq):
+        with self._lock:
+            cursor = self._db.execute("SELECT * FROM recordings WHERE seq = ?", (seq, ))
+            row = cursor.fetchone()
+        return dict(zip([c[0] for c in cursor.description], row)) if row else None
+
+    # Return the recordings after the given sequence number (oldest first) as a list of dicts, at most limit of them
+    def since(self, seq, limit):
+        with self._lock:
+            cursor = self._db.execute("SELECT * FROM recordings WHERE seq > ? ORDER BY seq LIMIT ?", (seq, limit))
+            rows = cursor.fetchall()
+        return [dict(zip([c[0] for c in cursor.description], row)) for row in rows]
+
+    # Return the newest recordings (newest first) as a list of dicts, optionally filtered to the given statuses
+    def recent(self, count, statuses=None):
+        query, args = "SELECT * FROM recordings", ()
+        if statuses:
+            query += " WHERE status IN (%s)" % ",".join("?" * len(statuses))
+            args = tuple(statuses)
+        with self._lock:
+            cursor = self._db.execute(query + " ORDER BY seq DESC LIMIT ?", args + (count, ))
+            rows = cursor.fetchall()
+        return [dict(zip([c[0] for c in cursor.description], row)) for row in rows]
+
+# Return the duration in seconds of a WAV file according to its header, or None if it can't be read
+def wav_duration(path):
+    try:
+        with wave.open(str(path), "rb") as wav:
+            return wav.getnframes() / wav.getframerate()
+    except Exception:
+        return None
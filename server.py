@@ -0,0 +1,208 @@
+import logging, os, re, json, struct, zipfile
+from time import monotonic, sleep
+from threading import Thread, get_native_id
+from urllib.parse import urlsplit, parse_qs, quote, unquote
+from pathlib import Path
+import metrics, recordings
+
+chunk_bytes   = 256 * 1024 # Most sent by one sendfile() call, so that a call starting part way through a download is noticed quickly
+busy_poll_s   = 0.5        # How often a paused download checks whether the call has ended
+feed_limit    = 500        # Most recordings returned by one request to the feed
+range_pattern = re.compile(r"^bytes=(\d*)-(\d*)$")
+content_types = {".wav": "audio/wav", ".flac": "audio/flac", ".opus": "audio/ogg"}
+
+# Serves the recordings of every line over HTTP so that they can be fetched without copying out/ by hand:
+#   GET /                                  the lines and the URL of each one's feed
+#   GET /lines/<name>/recordings?since=N   the recordings after sequence number N (oldest first, at most limit of them) with their metadata
+#                                          from the recording index, and the next_since to ask for next time. next_since stops short of any
+#                                          recording that is still in progress, so a client polling the feed picks it up once it has finished.
+#   GET /lines/<name>/recordings/<seq>     the recording itself, with Range support. Loose recordings and stored (uncompressed) archive members
+#                                          are sent straight from the page cache with sendfile(); deflated archive members are inflated on the fly.
+# Recordings are sent in chunks on handler threads running at the lowest CPU priority. While busy() says a call is in progress, a download
+# is paused between chunks, or limited to busy_rate bytes/s if that is set, so that it never competes with the recorder for the SD card.
+# Whatever busy_rate is, a download waits until post_processing() says no recording is being post-processed before it opens the file, so it
+# never reads a recording that silence detection is still trimming.
+class RecordingServer():
+    def __init__(self, indexes, port, address="127.0.0.1", busy=None, busy_rate=0, post_processing=None):
+        self._logger = logging.getLogger("Recording Server")
+        self._indexes = indexes # Line name -> RecordingIndex
+        self._port = port
+        self._address = address
+        self._busy = busy or (lambda: False)
+        self._busy_rate = busy_rate
+        self._post_processing = post_processing or (lambda: False)
+        self._server = None
+
+    def start(self):
+        from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler # Imported here since it takes a while and is rarely needed
+        server = self
+
+        class RecordingRequestHandler(BaseHTTPRequestHandler):
+            def setup(self):
+                super().setup()
+                try:
+                    os.setpriority(os.PRIO_PROCESS, get_native_id(), 19) # Only lowers the priority of this request's thread
+                except OSError:
+                    pass
+
+            def do_GET(self):
+                server.handle(self, head=False)
+
+            def do_HEAD(self):
+                server.handle(self, head=True)
+
+            def log_message(self, format, *args):
+                server._logger.debug("HTTP: " + format % args)
+
+        self._server = ThreadingHTTPServer((self._address, self._port), RecordingRequestHandler)
+        self._server.daemon_threads = True
+        Thread(target=self._server.serve_forever, name="Recording Server", daemon=True).start()
+        self._logger.info("Serving recordings at http://%s:%d/ (%s during calls)" % (self._address, self._port, "%d kB/s" %
+                          (self._busy_rate // 1024) if self._busy_rate else "paused"))
+
+    def stop(self):
+        if self._server:
+            self._server.shutdown()
+            self._server.server_close()
+
+    def handle(self, handler, head):
+        url = urlsplit(handler.path)
+        parts = [unquote(part) for part in url.path.strip("/").split("/") if part]
+        query = parse_qs(url.query)
+        try:
+            if not parts:
+                self._send_json(handler, head, {"lines": [{"name": name, "recordings": self._feed_url(name)} for name in self._indexes]})
+            elif len(parts) == 3 and parts[0] == "lines" and parts[1] in self._indexes and parts[2] == "recordings":
+                since = int(query.get("since", ["0"])[0])
+                limit = min(int(query.get("limit", [str(feed_limit)])[0]), feed_limit)
+                self._send_json(handler, head, self._feed(parts[1], since, limit))
+            elif len(parts) == 4 and parts[0] == "lines" and parts[1] in self._indexes and parts[2] == "recordings" and parts[3].isdigit():
+                self._send_recording(handler, head, parts[1], int(parts[3]))
+            else:
+                handler.send_error(404)
+        except ValueError as err:
+            handler.send_error(400, explain=str(err))
+        except (BrokenPipeError, ConnectionResetError):
+            self._logger.debug("Client went away during %s" % handler.path)
+        except (OSError, KeyError, zipfile.BadZipFile) as err:
+            self._logger.error("Unable to serve %s: %s: %s" % (handler.path, type(err).__name__, err))
+            handler.send_error(500)
+
+    def _feed_url(self, name, seq=None):
+        return "/lines/%s/recordings%s" % (quote(name, safe=""), "/%d" % seq if seq is not None else "")
+
+    def _feed(self, name, since, limit):
+        rows = self._indexes[name].since(since, limit)
+        next_since = rows[-1]["seq"] if rows else since
+        in_progress = [row["seq"] for row in rows if row["status"] in recordings.unfinished_statuses]
+        if in_progress: next_since = in_progress[0] - 1
+        return {"line": name, "since": since, "next_since": next_since, "recordings": [{
+            "seq":        row["seq"],
+            "file":       Path(row["path"]).name,
+            "status":     row["status"],
+            "start_time": row["start_time"],
+            "end_time":   row["end_time"],
+            "duration":   row["duration"],
+            "size":       row["size"],
+            "archived":   bool(row["archive"]),
+            "url":        self._feed_url(name, row["seq"]) if self._servable(row) else None,
+        } for row in rows]}
+
+    def _servable(self, row):
+        return row["status"] not in recordings.unfinished_statuses and row["status"] not in recordings.gone_statuses
+
+    def _send_json(self, handler, head, obj):
+        body = json.dumps(obj, indent=1).encode()
+        handler.send_response(200)
+        handler.send_header("Content-Type", "application/json")
+        handler.send_header("Content-Length", str(len(body)))
+        handler.end_headers()
+        if not head: handler.wfile.write(body)
+
+    def _send_recording(self, handler, head, name, seq):
+        row = self._indexes[name].get(seq)
+        if row is None:
+            handler.send_error(404)
+            return
+        if not self._servable(row):
+            handler.send_error(409 if row["status"] in recordings.unfinished_statuses else 410, explain="Recording is %s" % row["status"])
+            return
+        while self._post_processing(): sleep(busy_poll_s)
+        try:
+            source = self._open(row)
+        except FileNotFoundError:
+            row = self._indexes[name].get(seq) # Packed into an archive or evicted since the row was read
+            if not self._servable(row):
+                handler.send_error(410, explain="Recording is %s" % row["status"])
+                return
+            source = self._open(row)
+        with source[0]:
+            self._send_source(handler, head, row, *source)
+
+    # Return (file, offset of the recording in the file, size, whether sendfile() can be used)
+    def _open(self, row):
+        if not row["archive"]:
+            f = open(row["path"], "rb")
+            return f, 0, os.fstat(f.fileno()).st_size, True
+        with zipfile.ZipFile(row["archive"]) as zf:
+            info = zf.getinfo(Path(row["path"]).name)
+            if info.compress_type != zipfile.ZIP_STORED: return zf.open(info), 0, info.file_size, False # Keeps the archive open until closed
+        f = open(row["archive"], "rb")
+        # A stored member's data follows its local header, whose name and extra field lengths can differ from the central directory's
+        f.seek(info.header_offset)
+        name_length, extra_length = struct.unpack("<HH", f.read(30)[26:30])
+        return f, info.header_offset + 30 + name_length + extra_length, info.file_size, True
+
+    def _send_source(self, handler, head, row, f, base, size, zero_copy):
+        start, end = 0, size - 1
+        matched = range_pattern.match(handler.headers.get("Range", ""))
+        if matched and (matched[1] or matched[2]):
+            if not matched[1]:
+                start = max(0, size - int(matched[2])) # Suffix range: the last N bytes
+            else:
+                start = int(matched[1])
+                if matched[2]: end = min(end, int(matched[2]))
+            if start > end or start >= size:
+                handler.send_response(416)
+                handler.send_header("Content-Range", "bytes */%d" % size)
+                handler.send_header("Content-Length", "0")
+                handler.end_headers()
+                return
+        partial = (start, end) != (0, size - 1)
+        handler.send_response(206 if partial else 200)
+        handler.send_header("Content-Type", content_types.get(Path(row["path"]).suffix, "application/octet-stream"))
+        handler.send_header("Content-Length", str(end - start + 1))
+        handler.send_header("Accept-Ranges", "bytes")
+        if partial: handler.send_header("Content-Range", "bytes %d-%d/%d" % (start, end, size))
+        handler.end_headers()
+        if head: return
+
+        offset, remaining = base + start, end - start + 1
+        if not zero_copy:
+            while start > 0: start -= len(f.read(min(start, chunk_bytes))) # Inflated streams can't seek, so skip up to the range
+        while remaining > 0:
+            rate = self._pace()
+            chunk_start = monotonic()
+            count = min(remaining, chunk_bytes if rate is None else max(1024, rate // 4))
+            if zero_copy:
+                sent = os.sendfile(handler.connection.fileno(), f.fileno(), offset, count)
+            else:
+                data = f.read(count)
+                handler.wfile.write(data)
+                sent = len(data)
+            if not sent:
+                self._logger.warning("%s ended %d bytes early" % (row["path"], remaining))
+                handler.close_connection = True
+                break
+            offset += sent
+            remaining -= sent
+            metrics.inc("phony_served_bytes_total", sent)
+            if rate is not None: sleep(max(0, sent / rate - (monotonic() - chunk_start)))
+
+    # Wait while a call is in progress, unless downloads are allowed to carry on slowly during calls. Returns the rate to limit the download
+    # to, or None if it can go at full speed.
+    def _pace(self):
+        while self._busy():
+            if self._busy_rate: return self._busy_rate
+            sleep(busy_poll_s)
+        return None
@@ -0,0 +1,212 @@
+#!/usr/bin/python
+import logging, os, json, math, wave
+from argparse import ArgumentParser, RawTextHelpFormatter
+from time import monotonic
+from pathlib import Path
+import audio, encoder, recordings
+from recorder import trim_wav
+
+# Detector settings
+window_s       = 0.02  # Energy is measured over windows of this length
+threshold_dbfs = -45.0 # Windows with an RMS level above this (relative to full scale) count as voiced
+min_run_s      = 0.1   # Voiced stretches shorter than this (clicks, pops, the handset being put down) are ignored
+min_speech_s   = 0.3   # A recording with less voiced audio than this in total is considered empty
+pad_s          = 0.5   # Silence kept either side of the speech when trimming
+chunk_frames   = 64 * 1024 # Frames read at a time when analyzing files
+sidecar_suffix = ".silence.json"
+
+# Return the path of the metadata file kept next to a recording. It doesn't include the audio extension so that it still matches after the
+# recording has been converted to another format.
+def sidecar_path(path):
+    return Path(path).with_suffix(sidecar_suffix)
+
+# Streaming energy-based voice activity detector. Audio is fed in as it is captured, in chunks of any size, and each chunk is split into
+# fixed-length windows whose mean-square level is computed in one go with NumPy. Only a handful of counters are kept between chunks (the
+# first and last speech windows, the length of the voiced run in progress and so on), so memory use doesn't grow with the recording length.
+class SilenceDetector():
+    def __init__(self, rate=audio.sample_rate, nchannels=audio.channels, width=audio.sample_width, threshold_dbfs=threshold_dbfs,
+                 min_run_s=min_run_s, min_speech_s=min_speech_s):
+        import numpy # Imported here so that NumPy is only needed if silence detection is turned on
+        self._np = numpy
+        if width not in (2, 4): raise audio.AudioFormatError("%d byte samples are not supported" % width)
+        self._dtype = numpy.dtype("<i%d" % width)
+        self._rate = rate
+        self._frame_bytes = nchannels * width
+        self._window_samples = max(1, round(rate * window_s)) * nchannels
+        self._window_bytes = self._window_samples * width
+        self._window_s = self._window_samples / nchannels / rate
+        self._full_scale = float(2 ** (8 * width - 1))
+        self._threshold_dbfs = threshold_dbfs
+        self._threshold = (self._full_scale * 10 ** (threshold_dbfs / 20)) ** 2 # Compared against mean squares so no logs are needed per window
+        self._min_run = max(1, round(min_run_s / self._window_s))
+        self._min_speech_s = min_speech_s
+        self._pending = b"" # Bytes left over from the last chunk that didn't fill a window
+        self._windows = 0
+        self._run = 0 # Length in windows of the voiced run that the last chunk ended in
+        self._speech_windows = 0
+        self._first = None
+        self._last = None
+        self._peak = 0.0
+
+    def feed(self, data):
+        np = self._np
+        if self._pending: data = self._pending + bytes(data)
+        usable = len(data) - len(data) % self._window_bytes
+        self._pending = bytes(data[usable:])
+        if not usable: return
+
+        windows = np.frombuffer(data, dtype=self._dtype, count=usable // self._dtype.itemsize).astype(np.float32).reshape(-1, self._window_samples)
+        windows -= windows.mean(axis=1, keepdims=True) # Remove any DC offset so that it doesn't read as energy
+        power = np.einsum("ij,ij->i", windows, windows) / self._window_samples
+        self._peak = max(self._peak, float(power.max()))
+        voiced = power > self._threshold
+
+        # Find every voiced run in this chunk. A run starting at the first window carries on the run the last chunk ended in, if there was one.
+        edges = np.diff(voiced.astype(np.int8), prepend=0, append=0)
+        starts = np.flatnonzero(edges == 1) + self._windows
+        ends = np.flatnonzero(edges == -1) + self._windows
+        lengths = ends - starts
+        carry = self._run if len(starts) and starts[0] == self._windows else 0
+        if carry:
+            starts[0] -= carry
+            lengths[0] += carry
+        speech = lengths >= self._min_run
+        if speech.any():
+            if self._first is None: self._first = int(starts[speech][0])
+            self._last = int(ends[speech][-1])
+            self._speech_windows += int(lengths[speech].sum())
+            if carry >= self._min_run: self._speech_windows -= carry # Already counted with the last chunk
+        self._run = int(lengths[-1]) if voiced[-1] else 0
+        self._windows += len(voiced)
+
+    # Return the analysis of everything fed in so far. Times are in seconds from the start of the recording.
+    def result(self):
+        speech_s = self._speech_windows * self._window_s
+        return {
+            "duration_s":     self._windows * self._window_s + len(self._pending) // self._frame_bytes / self._rate,
+            "sample_rate":    self._rate,
+            "has_speech":     speech_s >= self._min_speech_s,
+            "speech_s":       speech_s,
+            "speech_start_s": self._first * self._window_s if self._first is not None else None,
+            "speech_end_s":   self._last * self._window_s if self._last is not None else None,
+            "peak_dbfs":      10 * math.log10(self._peak) - 20 * math.log10(self._full_scale) if self._peak else None,
+            "threshold_dbfs": self._threshold_dbfs,
+        }
+
+# Act on the analysis of a finished recording. A recording with speech is trimmed down to the speech plus pad_s either side (WAV only; a
+# compressed recording would have to be re-encoded, so only the trim points are recorded for those). A recording without any speech is
+# deleted if empty_action is 'discard' and otherwise kept and flagged. The analysis is saved to the sidecar file next to the recording, unless
+# it was deleted. Returns the sidecar contents, which include the action taken and the length of the recording that was kept.
+def process_recording(path, result, empty_action="flag", trim=True):
+    path = Path(path)
+    meta = dict(result, file=path.name, action="kept", kept_start_s=0.0, kept_end_s=result["duration_s"], trimmed=False)
+    if not result["has_speech"]:
+        if empty_action == "discard":
+            os.remove(path)
+            meta["action"] = "discarded"
+            meta["kept_end_s"] = 0.0
+            return meta
+        meta["action"] = "flagged"
+    elif trim:
+        meta["kept_start_s"] = max(0.0, result["speech_start_s"] - pad_s)
+        meta["kept_end_s"] = min(result["duration_s"], result["speech_end_s"] + pad_s)
+        if path.suffix == ".wav" and (meta["kept_start_s"] > 0 or meta["kept_end_s"] < result["duration_s"]):
+            rate = result["sample_rate"]
+            trim_wav(path, round(meta["kept_start_s"] * rate), round(meta["kept_end_s"] * rate))
+            meta["trimmed"] = True
+
+    sidecar = sidecar_path(path)
+    tmp_path = str(sidecar) + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(meta, f, indent=2)
+    os.replace(tmp_path, sidecar)
+    return meta
+
+# Analyze and process a single recording, reading it chunk_frames at a time. Compressed recordings are decoded on the fly. This runs in the
+# batch mode's worker processes, so it only takes and returns picklable values.
+def process_file(path, empty_action="flag", trim=True, threshold=threshold_dbfs):
+    decoder = encoder.open_decoder(path) if encoder.is_compressed(path) else None
+    try:
+        with wave.open(decoder.stdout if decoder else str(path), "rb") as wav:
+            detector = SilenceDetector(rate=wav.getframerate(), nchannels=wav.getnchannels(), width=wav.getsampwidth(), threshold_dbfs=threshold)
+            while True:
+                data = wav.readframes(chunk_frames)
+                if not data: break
+                detector.feed(data)
+    finally:
+        if decoder:
+            decoder.stdout.close()
+            decoder.wait()
+    return process_recording(path, detector.result(), empty_action=empty_action, trim=trim)
+
+# Return the index status for a recording that process_recording() took the given action on, or None if the status shouldn't change
+def index_status(meta):
+    return {"flagged": recordings.STATUS_EMPTY, "discarded": recordings.STATUS_DISCARDED}.get(meta["action"])
+
+# Process every finished recording in out_dir's recording index that doesn't have a sidecar yet (or all of them if force is set) using a pool
+# of worker processes, one per core by default, and update the index with the new statuses and durations. Recordings come from the index
+# rather than a directory listing so that the one phony may be recording right now is never trimmed or deleted. Returns a dict of statistics.
+def process_archive(logger, out_dir, recording_index, empty_action="flag", trim=True, jobs=None, force=False, threshold=threshold_dbfs):
+    from concurrent.futures import ProcessPoolExecutor, as_completed # Imported here since multiprocessing is slow to import and phony doesn't need it
+    extensions = {".wav"} | {"." + fmt for fmt in encoder.formats}
+    rows = [row for row in recording_index.stored() if not row["archive"] and Path(row["path"]).suffix in extensions and
+            os.path.exists(row["path"]) and (force or not sidecar_path(row["path"]).exists())]
+    seqs = {Path(row["path"]): row["seq"] for row in rows}
+    paths = list(seqs)
+    jobs = jobs or os.cpu_count()
+    logger.info("Analyzing %d recordings in %s using %d jobs" % (len(paths), out_dir, jobs))
+
+    stats = {"files": 0, "failed": 0, "empty": 0, "discarded": 0, "trimmed": 0, "audio_s": 0.0, "removed_s": 0.0}
+    start = monotonic()
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        futures = {pool.submit(process_file, str(path), empty_action, trim, threshold): path for path in paths}
+        for future in as_completed(futures):
+            path = futures[future]
+            try:
+                meta = future.result()
+            except Exception as err:
+                logger.error("Unable to analyze %s: %s: %s" % (path, type(err).__name__, err))
+                stats["failed"] += 1
+                continue
+            kept_s = meta["kept_end_s"] - meta["kept_start_s"]
+            stats["files"] += 1
+            stats["empty"] += not meta["has_speech"]
+            stats["discarded"] += meta["action"] == "discarded"
+            stats["trimmed"] += meta["trimmed"]
+            stats["audio_s"] += meta["duration_s"]
+            stats["removed_s"] += meta["duration_s"] - kept_s
+            logger.debug("%s: %s, %.1f s of speech, kept %.1f of %.1f s" % (path.name, meta["action"], meta["speech_s"], kept_s, meta["duration_s"]))
+            recording_index.update(seqs[path], status=index_status(meta), duration=kept_s if meta["trimmed"] else None)
+    stats["wall_s"] = monotonic() - start
+
+    stats["realtime_factor"] = stats["audio_s"] / stats["wall_s"] if stats["wall_s"] else 0
+    logger.info("Analyzed %d files (%d failed) in %.2f s (%.0fx realtime). %d had no speech (%d discarded), %d were trimmed, removing %.1f s of "
+                "silence from %.1f s of audio" % (stats["files"], stats["failed"], stats["wall_s"], stats["realtime_factor"], stats["empty"],
+                                                  stats["discarded"], stats["trimmed"], stats["removed_s"], stats["audio_s"]))
+    return stats
+
+# Parse script input arguments.
+def parse_args():
+    desc_str = ("Trims the silence from the recordings in the output directory and flags or discards the ones without any speech\n\n")
+    parser = ArgumentParser(formatter_class=RawTextHelpFormatter, description=desc_str)
+    parser.add_argument("out_dir", type=str, help="The directory containing the recordings")
+    parser.add_argument("--empty-calls", choices=["flag", "discard"], default="flag", help="What to do with recordings that have no speech\n"
+                                                                                            "(default=%(default)s)")
+    parser.add_argument("--no-trim", action="store_true", help="If specified, only analyze the recordings and don't trim them")
+    parser.add_argument("--threshold", type=float, default=threshold_dbfs, help="Level in dBFS above which audio counts as speech (default=%(default)s)")
+    parser.add_argument("-j", "--jobs", type=int, default=os.cpu_count(), help="The number of files to process in parallel (default=%(default)s)")
+    parser.add_argument("--force", action="store_true", help="If specified, also reprocess recordings that already have a %s file" % sidecar_suffix)
+    parser.add_argument("--debug", action="store_true", help="If specified, log messages at DEBUG level and higher will be printed to the console")
+    return parser.parse_args()
+
+if (__name__ == "__main__"):
+    import util
+    args = parse_args()
+    util.init_logging(console_level=(logging.DEBUG if args.debug else logging.INFO))
+    logger = logging.getLogger(name=Path(__file__).name)
+
+    recording_index = recordings.RecordingIndex(out_dir=args.out_dir)
+    recording_index.open(recover=False) # phony may be running and recording into the same directory
+    process_archive(logger, args.out_dir, recording_index, empty_action=args.empty_calls, trim=not args.no_trim, jobs=args.jobs, force=args.force,
+                    threshold=args.threshold)
+    recording_index.close()
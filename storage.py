@@ -0,0 +1,252 @@
+import logging, os, re, shutil, gzip, zipfile
+from time import time
+from threading import Thread, Event, get_native_id
+from pathlib import Path
+import audio, encoder, metrics, recordings, silence
+
+log_pattern       = re.compile(r"^phony_.*\.log")
+eviction_policies = ("oldest", "empty-first", "none")
+
+# Parse a size such as '500M' or '8G' into bytes
+def parse_size(text):
+    units = {"": 1, "K": 1024, "M": 1024 ** 2, "G": 1024 ** 3, "T": 1024 ** 4}
+    matched = re.fullmatch(r"([0-9.]+)\s*([KMGT]?)i?B?", text.strip().upper())
+    if matched is None: raise ValueError("Invalid size '%s'" % text)
+    return int(float(matched[1]) * units[matched[2]])
+
+# Keeps the output directory from growing without bound. A background thread, running at the lowest CPU priority so it never competes with
+# a call, periodically:
+# - compresses phony_*.log files other than the one being written and, if log_max_age_days is given, deletes compressed logs older than that
+# - if archive_after_days is given, packs recordings older than that into zip segment archives of segment_size consecutive recording numbers, so out/ holds a
+#   few large files instead of thousands of small ones. WAV recordings are deflated and already compressed formats are stored. A zip's central
+#   directory makes any recording in it readable without touching the rest of the segment.
+# - evicts the oldest data (according to the eviction policy) while the directory is over quota_bytes or the filesystem is more than
+#   quota_percent full. The newest keep_recent recordings are never evicted.
+# has_room() is called before each recording starts, so a call is never started without reserve_s worth of space to finish it in.
+class StorageManager():
+    def __init__(self, out_dir, recording_index, quota_bytes=None, quota_percent=None, eviction="oldest", archive_after_days=None,
+                 segment_size=100, log_max_age_days=None, active_log=None, reserve_s=600, keep_recent=10, interval_s=600):
+        if eviction not in eviction_policies: raise ValueError("Unknown eviction policy '%s'" % eviction)
+        self._logger = logging.getLogger("Storage")
+        self._out_dir = Path(out_dir).resolve()
+        self._archive_dir = Path(self._out_dir, recordings.archive_dir_name)
+        self._index = recording_index
+        self._quota_bytes = quota_bytes
+        self._quota_percent = quota_percent
+        self._eviction = eviction
+        self._archive_after_s = archive_after_days * 24 * 3600 if archive_after_days else None
+        self._segment_size = segment_size
+        self._log_max_age_s = log_max_age_days * 24 * 3600 if log_max_age_days else None
+        self._active_log = str(Path(active_log).resolve()) if active_log else None
+        self._reserve_bytes = reserve_s * audio.sample_rate * audio.frame_bytes
+        self._keep_recent = keep_recent
+        self._interval_s = interval_s
+        self._used_bytes = 0
+        self._stop = Event()
+        self._wake = Event()
+        self._thread = Thread(target=self._run, name="Storage Manager", daemon=True)
+
+    # Start the background thread. Its first pass runs straight away, so this is best called once phony is ready to take calls so that it
+    # doesn't compete with startup for the SD card.
+    def start(self):
+        self._logger.info("Managing %s (quota %s, %s full, eviction %s, archiving after %s days)" %
+                          (self._out_dir, "%d MB" % (self._quota_bytes // 1024 ** 2) if self._quota_bytes else "none",
+                           "%g%%" % self._quota_percent if self._quota_percent else "any", self._eviction,
+                           "%g" % (self._archive_after_s / 86400) if self._archive_after_s else "never"))
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._wake.set()
+        if self._thread.is_alive(): self._thread.join()
+
+    # Return True if there is enough space for a full-length call. Called on the call path, so it only costs a statvfs() call. If there isn't
+    # room the background thread is woken to make some.
+    def has_room(self):
+        usage = shutil.disk_usage(self._out_dir)
+        metrics.set_gauge("phony_storage_free_bytes", usage.free)
+        room = usage.free >= self._reserve_bytes
+        if self._quota_bytes is not None and self._used_bytes + self._reserve_bytes > self._quota_bytes: room = False
+        if self._quota_percent is not None and usage.used + self._reserve_bytes > usage.total * self._quota_percent / 100: room = False
+        if not room: self._wake.set()
+        return room
+
+    def _run(self):
+        # Linux gives each thread its own nice value, so this only lowers the priority of this thread
+        try:
+            os.setpriority(os.PRIO_PROCESS, get_native_id(), 19)
+        except OSError as err:
+            self._logger.warning("Unable to lower the storage manager's priority: %s" % err)
+        try:
+            self._remove_packed()
+        except Exception as err:
+            self._logger.error("Unable to clean up packed recordings: %s: %s" % (type(err).__name__, err))
+        while not self._stop.is_set():
+            try:
+                self.run_once()
+            except Exception as err:
+                self._logger.error("Storage pass failed: %s: %s" % (type(err).__name__, err))
+            self._wake.wait(self._interval_s)
+            self._wake.clear()
+
+    # Do one pass of log compression, archiving and quota enforcement
+    def run_once(self):
+        self._compress_logs()
+        if self._archive_after_s is not None: self._archive(time() - self._archive_after_s)
+        self._used_bytes = self._directory_size()
+        self._enforce_quota()
+        metrics.set_gauge("phony_storage_used_bytes", self._used_bytes)
+
+    def _directory_size(self):
+        total = 0
+        for directory in (self._out_dir, self._archive_dir):
+            if not directory.is_dir(): continue
+            for entry in os.scandir(directory):
+                if entry.is_file(follow_symlinks=False): total += entry.stat().st_size
+        return total
+
+    def _compress_logs(self):
+        now = time()
+        for entry in os.scandir(self._out_dir):
+            if not log_pattern.match(entry.name) or entry.name.endswith(".tmp") or not entry.is_file() or entry.path == self._active_log: continue
+            if entry.name.endswith(".gz"):
+                if self._log_max_age_s is not None and now - entry.stat().st_mtime > self._log_max_age_s:
+                    self._logger.info("Deleting old log %s" % entry.name)
+                    os.remove(entry.path)
+                continue
+            gz_path = unique_path(entry.path + ".gz")
+            tmp_path = gz_path + ".tmp"
+            with open(entry.path, "rb") as src, gzip.open(tmp_path, "wb") as dst:
+                shutil.copyfileobj(src, dst, 1024 * 1024)
+            shutil.copystat(entry.path, tmp_path) # Keep the modification time so that the age limit still applies from when the log was written
+            os.replace(tmp_path, gz_path)
+            os.remove(entry.path)
+            self._logger.debug("Compressed %s" % entry.name)
+
+    # Pack every segment whose recordings have all finished before cutoff. A segment is only packed once every recording number in its range
+    # has been handed out, so archives are written once and never appended to.
+    def _archive(self, cutoff):
+        newest = self._index.recent(1)
+        if not newest: return
+        segments = {}
+        for row in self._index.stored():
+            if row["archive"] is None: segments.setdefault((row["seq"] - 1) // self._segment_size, []).append(row)
+        for segment, rows in sorted(segments.items()):
+            first, last = segment * self._segment_size + 1, (segment + 1) * self._segment_size
+            if self._stop.is_set() or last >= newest[0]["seq"]: break
+            if any(row["end_time"] is None or row["end_time"] >= cutoff for row in rows): continue
+            self._pack(Path(self._archive_dir, "recordings_%06d-%06d.zip" % (first, last)), rows)
+
+    def _pack(self, archive, rows):
+        rows = [row for row in rows if os.path.exists(row["path"])]
+        if not rows: return
+        self._archive_dir.mkdir(exist_ok=True)
+        tmp_path = str(archive) + ".tmp"
+        with zipfile.ZipFile(tmp_path, "w") as zf:
+            for row in rows:
+                path = Path(row["path"])
+                zf.write(path, path.name, compress_type=zipfile.ZIP_STORED if encoder.is_compressed(path) else zipfile.ZIP_DEFLATED)
+                sidecar = silence.sidecar_path(path)
+                if sidecar.exists(): zf.write(sidecar, sidecar.name, compress_type=zipfile.ZIP_DEFLATED)
+        with open(tmp_path, "rb") as f:
+            os.fsync(f.fileno())
+        os.replace(tmp_path, archive)
+
+        # Only delete the originals once the archive is safely in place and the index points at it
+        self._index.set_archive([row["seq"] for row in rows], archive)
+        for row in rows:
+            os.remove(row["path"])
+            sidecar = silence.sidecar_path(row["path"])
+            if sidecar.exists(): os.remove(sidecar)
+        self._logger.info("Packed %d recordings into %s (%.1f MB -> %.1f MB)" % (len(rows), archive.name,
+                          sum(row["size"] or 0 for row in rows) / 1e6, os.path.getsize(archive) / 1e6))
+
+    # Delete loose recordings (and sidecars) that are already in an archive according to the index. _pack() only leaves these behind if phony
+    # stopped between updating the index and deleting them, so this is done once when the manager starts.
+    def _remove_packed(self):
+        for row in self._index.stored():
+            if not row["archive"] or not os.path.exists(row["path"]) or not os.path.exists(row["archive"]): continue
+            self._logger.info("Removing %s, which is already in %s" % (Path(row["path"]).name, Path(row["archive"]).name))
+            os.remove(row["path"])
+            sidecar = silence.sidecar_path(row["path"])
+            if sidecar.exists(): os.remove(sidecar)
+
+    # How many bytes need to be freed to get back under quota
+    def _excess_bytes(self):
+        excess = 0
+        if self._quota_bytes is not None: excess = self._used_bytes + self._reserve_bytes - self._quota_bytes
+        if self._quota_percent is not None:
+            usage = shutil.disk_usage(self._out_dir)
+            excess = max(excess, usage.used + self._reserve_bytes - int(usage.total * self._quota_percent / 100))
+        return excess
+
+    # Return everything that can be evicted as (sort key, description, seqs, paths) tuples in eviction order. Compressed logs always go
+    # first. A segment archive is evicted as a whole.
+    def _eviction_candidates(self):
+        candidates = []
+        for entry in os.scandir(self._out_dir):
+            if log_pattern.match(entry.name) and entry.name.endswith(".gz"):
+                candidates.append(((0, entry.stat().st_mtime), entry.name, [], [entry.path]))
+
+        rows = self._index.stored()
+        protected = {row["seq"] for row in rows[-self._keep_recent:]} if self._keep_recent else set()
+        protected_archives = {row["archive"] for row in rows if row["seq"] in protected and row["archive"]} # Can only go as a whole
+        archives = {}
+        for row in rows:
+            if row["seq"] in protected or row["archive"] in protected_archives: continue
+            if row["archive"]:
+                archives.setdefault(row["archive"], []).append(row["seq"])
+                continue
+            empty_first = self._eviction == "empty-first" and row["status"] == recordings.STATUS_EMPTY
+            candidates.append(((1 if empty_first else 2, row["seq"]), Path(row["path"]).name, [row["seq"]],
+                               [row["path"], str(silence.sidecar_path(row["path"]))]))
+        for archive, seqs in archives.items():
+            candidates.append(((2, min(seqs)), Path(archive).name, seqs, [archive]))
+        return sorted(candidates)
+
+    def _enforce_quota(self):
+        excess = self._excess_bytes()
+        if excess <= 0: return
+        if self._eviction == "none":
+            self._logger.warning("%s is %.1f MB over quota but eviction is disabled" % (self._out_dir, excess / 1e6))
+            return
+        self._logger.warning("%s is %.1f MB over quota. Evicting the %s data" % (self._out_dir, excess / 1e6, self._eviction))
+        for _, name, seqs, paths in self._eviction_candidates():
+            if excess <= 0 or self._stop.is_set(): break
+            freed = 0
+            for path in paths:
+                try:
+                    size = os.path.getsize(path)
+                    os.remove(path)
+                    freed += size
+                except FileNotFoundError:
+                    pass
+            if seqs: self._index.evict(seqs)
+            metrics.inc("phony_recordings_evicted_total", len(seqs))
+            self._logger.info("Evicted %s (%.1f MB)" % (name, freed / 1e6))
+            excess -= freed
+            self._used_bytes -= freed
+        if excess > 0: self._logger.error("Still %.1f MB over quota after evicting everything that can be" % (excess / 1e6))
+
+# Return path, or if it already exists, the first of path with '.1', '.2', ... inserted before the extension that doesn't
+def unique_path(path):
+    base, ext = os.path.splitext(path)
+    candidate, count = path, 1
+    while os.path.exists(candidate):
+        candidate, count = "%s.%d%s" % (base, count, ext), count + 1
+    return candidate
+
+# Return a path that a recording from the index can be played from. Loose recordings are played in place; archived ones are extracted from
+# their segment (reading only that member) into cache_dir, replacing whatever was extracted there last time. Each Phone has its own cache_dir
+# so that lines replaying at the same time don't delete each other's files.
+def playable_path(row, cache_dir):
+    if not row.get("archive"): return row["path"]
+    cache_dir = Path(cache_dir)
+    name = Path(row["path"]).name
+    for old in cache_dir.iterdir():
+        if old.name != name: old.unlink()
+    path = Path(cache_dir, name)
+    if not path.exists():
+        with zipfile.ZipFile(row["archive"]) as zf:
+            zf.extract(name, cache_dir)
+    return str(path)
@@ -1,5 +1,4 @@
-import logging, os, datetime, math, shutil
-from colorama import just_fix_windows_console
+import logging, logging.handlers, queue, atexit, os, datetime, math, shutil
 
 term_colors = {
     "off":     "\033[0m"    ,
@@ -68,23 +67,97 @@ class LogFormatter(logging.Formatter):
             logging.CRITICAL: (term_colors["bold_red"] if en_colors else "") + "{message}" + (term_colors["off"] if en_colors else ""),
         }
 
+        # Build the Formatter objects once up front rather than for every record
+        self.verbatim_formatter = logging.Formatter("{message}", style="{")
+        self.verbatim_colored_formatters = {level: logging.Formatter(fmt, style="{") for level, fmt in self.verbatim_colored_formats.items()}
+        self.regular_formatters = {level: logging.Formatter(fmt, style="{") for level, fmt in self.regular_formats.items()}
+
     def format(self, record):
         if (record.name == "verbatim"):
             # If the special 'verbatim' logger is used, it will emit a message as-is with no format modifications
-            return logging.Formatter("{message}", style="{").format(record)
+            return self.verbatim_formatter.format(record)
         elif (record.name == "verbatim_colored"):
             # If the special 'verbatim_colored' logger is used, it will emit a message whose only format modifcation is the text color
             # which is set depending on severity level.
-            return logging.Formatter(self.verbatim_colored_formats[record.levelno], style="{").format(record)
+            return self.verbatim_colored_formatters[record.levelno].format(record)
         else:
-            return logging.Formatter(self.regular_formats[record.levelno], style="{").format(record)
+            return self.regular_formatters[record.levelno].format(record)
+
+# Log file handler that rolls the file over when it reaches max_bytes as well as at the interval given by 'when' (see
+# TimedRotatingFileHandler), whichever comes first.
+class SizedTimedRotatingFileHandler(logging.handlers.TimedRotatingFileHandler):
+    def __init__(self, filename, max_bytes=0, **kwargs):
+        super().__init__(filename, **kwargs)
+        self.max_bytes = max_bytes
+
+    def shouldRollover(self, record):
+        if self.max_bytes > 0 and self.stream is not None and self.stream.tell() >= self.max_bytes:
+            return True
+        return super().shouldRollover(record)
+
+    # Size based rollovers can happen several times in one interval, and so would get the same time-stamped name. Number them instead of
+    # letting each one overwrite the last.
+    def rotation_filename(self, default_name):
+        name, count = super().rotation_filename(default_name), 1
+        while os.path.exists(name):
+            name, count = "%s.%d" % (default_name, count), count + 1
+        return name
+
+    # The numbered names don't sort in age order, so pick the oldest backups by modification time instead
+    def getFilesToDelete(self):
+        backup_count, self.backupCount = self.backupCount, 0
+        try:
+            backups = sorted(super().getFilesToDelete(), key=os.path.getmtime)
+        finally:
+            self.backupCount = backup_count
+        return backups[:max(0, len(backups) - backup_count)]
+
+# QueueHandler for a bounded queue. If the queue is full the record is dropped and counted instead of blocking the thread that logged it,
+# so a stalled log file can never hold up the call path. The number of dropped records is reported by the listener once there is room again.
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    def __init__(self, queue):
+        super().__init__(queue)
+        self.dropped = 0
+        self._reported = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+            return
+        if self.dropped != self._reported:
+            # Let the log know how much it missed. If this doesn't fit either it'll be reported next time.
+            notice = logging.LogRecord(__name__, logging.WARNING, __file__, 0, "%d log messages were dropped because the log queue was full" %
+                                       (self.dropped - self._reported), None, None)
+            try:
+                self.queue.put_nowait(notice)
+                self._reported = self.dropped
+            except queue.Full:
+                pass
+
+# QueueListener whose stop() waits for room in a full queue rather than raising queue.Full, so that everything logged before exit is written
+class LogQueueListener(logging.handlers.QueueListener):
+    def enqueue_sentinel(self):
+        self.queue.put(self._sentinel)
+
+# The handler and listener set up by init_logging(), and the log file being written to (if any)
+log_queue_handler = None
+log_queue_listener = None
+log_file_path = None
 
 # This function is intended to be called before any messages have been logged. It sets up the root logger and creates two handlers,
-# one for the console, and one for the log file that the test run will record to.
-def init_logging(console_level=logging.INFO, logfile=False, logfile_level=logging.DEBUG, logfile_dir=None, logfile_name=None):
+# one for the console, and one for the log file that the test run will record to. The handlers are run by a single listener thread fed
+# through a bounded queue, so logging from the GPIO callbacks and the runner threads never waits on the console or the SD card. The log file
+# is rotated when it reaches logfile_max_bytes and at logfile_rotate_when, keeping logfile_backups old files.
+def init_logging(console_level=logging.INFO, logfile=False, logfile_level=logging.DEBUG, logfile_dir=None, logfile_name=None,
+                 logfile_max_bytes=10 * 1024 * 1024, logfile_rotate_when="midnight", logfile_backups=7, queue_size=10000):
+    global log_queue_handler, log_queue_listener, log_file_path
+
     # Configure the root logger to record all messages.
     root_logger = logging.getLogger()
     root_logger.setLevel(logging.TRACE)
+    handlers = []
 
     # Add log handler to emit messages to the given logfile.
     if (logfile):
@@ -93,16 +166,39 @@ def init_logging(console_level=logging.INFO, logfile=False, logfile_level=loggin
             logfile_full_path = os.path.join(logfile_dir, logfile_name)
         else:
             logfile_full_path = os.path.join(os.path.abspath(os.getcwd()), logfile_name)
-        logfile_handler = logging.FileHandler(filename=logfile_full_path, mode="w")
+        logfile_handler = SizedTimedRotatingFileHandler(filename=logfile_full_path, max_bytes=logfile_max_bytes, when=logfile_rotate_when,
+                                                        backupCount=logfile_backups)
         logfile_handler.setLevel(logfile_level)
         logfile_handler.setFormatter(LogFormatter(en_colors=False, en_timestamps=True, en_filenames=True, en_linenums=True))
-        root_logger.addHandler(logfile_handler)
+        handlers.append(logfile_handler)
+        log_file_path = logfile_full_path
+
+    # The console handler uses ANSI colors, which only Windows needs help with. colorama is only imported there, so it isn't loaded at startup
+    # on the Pi.
+    if os.name == "nt":
+        from colorama import just_fix_windows_console
+        just_fix_windows_console()
 
     # Add log handler to emit messages to the console
     console_handler = logging.StreamHandler()
     console_handler.setLevel(console_level)
     console_handler.setFormatter(LogFormatter(en_colors=True, en_timestamps=False, en_filenames=False, en_linenums=False))
-    root_logger.addHandler(console_handler)
+    handlers.append(console_handler)
+
+    # Route everything through the queue to the listener thread, which owns the real handlers
+    log_queue_handler = DroppingQueueHandler(queue.Queue(maxsize=queue_size))
+    log_queue_handler.setLevel(min(handler.level for handler in handlers))
+    root_logger.addHandler(log_queue_handler)
+    log_queue_listener = LogQueueListener(log_queue_handler.queue, *handlers, respect_handler_level=True)
+    log_queue_listener.start()
+    atexit.register(stop_logging)
+
+# Flush any queued messages and stop the listener thread. Called automatically at exit.
+def stop_logging():
+    global log_queue_listener
+    if log_queue_listener:
+        log_queue_listener.stop()
+        log_queue_listener = None
 
 # Generates a 'banner', which is a string composed of repeated separator characters with text centered in the middle. The width of
 # the banner is equal to the current terminal width. Example: